@@ -25,6 +25,7 @@ import numpy as np
 import _thread as thread
 import paths_factory
 from recorders.video_capture import VideoCapture
+from kernels import best_match, frame_darkness
 from i18n import _
 
 # Import optimization modules
@@ -55,7 +56,7 @@ def exit(code=None):
 
 def init_detector(lock):
 	"""Start face detector, encoder and predictor in a new thread"""
-	global face_detector, pose_predictor, face_encoder, daemon_client
+	global daemon_client
 
 	# Try to use daemon first if available
 	if DAEMON_AVAILABLE and config.getboolean("daemon", "enabled", fallback=False):
@@ -70,15 +71,30 @@ def init_detector(lock):
 				print(_("Daemon not available, falling back to direct loading"))
 		except Exception as e:
 			print(_("Daemon error: {}").format(str(e)))
+
+		# Only keep the client around if the daemon is actually serving requests
+		daemon_client = None
 	
 	# Fallback to original loading
+	if not load_models():
+		lock.release()
+		exit(1)
+
+	# Note the time it took to initialize detectors
+	timings["ll"] = time.time() - timings["ll"]
+	lock.release()
+
+
+def load_models():
+	"""Load the face detector, encoder and predictor in this process, False if the data files are missing"""
+	global face_detector, pose_predictor, face_encoder
+
 	# Test if at lest 1 of the data files is there and abort if it's not
 	if not os.path.isfile(paths_factory.shape_predictor_5_face_landmarks_path()):
 		print(_("Data files have not been downloaded, please run the following commands:"))
 		print("\n\tcd " + paths_factory.dlib_data_dir_path())
 		print("\tsudo ./install.sh\n")
-		lock.release()
-		exit(1)
+		return False
 
 	# Use the CNN detector if enabled
 	if use_cnn:
@@ -89,10 +105,7 @@ def init_detector(lock):
 	# Start the others regardless
 	pose_predictor = dlib.shape_predictor(paths_factory.shape_predictor_5_face_landmarks_path())
 	face_encoder = dlib.face_recognition_model_v1(paths_factory.dlib_face_recognition_resnet_model_v1_path())
-
-	# Note the time it took to initialize detectors
-	timings["ll"] = time.time() - timings["ll"]
-	lock.release()
+	return True
 
 
 def make_snapshot(type):
@@ -167,6 +180,9 @@ except FileNotFoundError:
 if len(models) < 1:
 	exit(10)
 
+# Keep the known encodings as one contiguous float32 matrix for the matching kernel
+encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+
 # Read config from disk
 config = configparser.ConfigParser()
 config.read(paths_factory.config_file_path())
@@ -256,6 +272,15 @@ clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
 # Let the ui know that we're ready
 send_to_ui("M", _("Identifying you..."))
 
+# Size and output buffers of the scaled frames, set up on the first frame and reused after that
+scaled_size = None
+frame_small = None
+gsframe_small = None
+
+# Last ui subtext update and the last liveness message shown
+last_ui_update = 0
+last_feedback = None
+
 # Start the read loop
 frames = 0
 valid_frames = 0
@@ -266,12 +291,17 @@ while True:
 	# Increment the frame count every loop
 	frames += 1
 
-	# Form a string to let the user know we're real busy
-	ui_subtext = "Scanned " + str(valid_frames - dark_tries) + " frames"
-	if (dark_tries > 1):
-		ui_subtext += " (skipped " + str(dark_tries) + " dark frames)"
-	# Show it in the ui as subtext
-	send_to_ui("S", ui_subtext)
+	# Update the ui at most 10 times a second, it can't show more anyway
+	ui_time = time.monotonic()
+	if ui_time - last_ui_update > 0.1:
+		last_ui_update = ui_time
+
+		# Form a string to let the user know we're real busy
+		ui_subtext = "Scanned " + str(valid_frames - dark_tries) + " frames"
+		if (dark_tries > 1):
+			ui_subtext += " (skipped " + str(dark_tries) + " dark frames)"
+		# Show it in the ui as subtext
+		send_to_ui("S", ui_subtext)
 
 	# Stop if we've exceeded the time limit
 	if time.time() - timings["fr"] > timeout:
@@ -288,7 +318,6 @@ while True:
 
 	# Grab a single frame of video
 	frame, gsframe = video_capture.read_frame()
-	gsframe = clahe.apply(gsframe)
 
 	# If snapshots have been turned on
 	if save_failed or save_successful:
@@ -296,17 +325,24 @@ while True:
 		if len(snapframes) < 3:
 			snapframes.append(frame)
 
-	# Create a histogram of the image with 8 values
-	hist = cv2.calcHist([gsframe], [0], None, [8], [0, 256])
-	# All values combined for percentage calculation
-	hist_total = np.sum(hist)
+	# If the height is too high, scale the grayscale frame first
+	# so the histogram equalization only runs over the pixels that are actually used
+	if scaling_factor != 1:
+		if scaled_size is None:
+			scaled_size = (round(gsframe.shape[1] * scaling_factor), round(gsframe.shape[0] * scaling_factor))
+			gsframe_small = np.empty((scaled_size[1], scaled_size[0]), gsframe.dtype)
+			frame_small = np.empty((scaled_size[1], scaled_size[0]) + frame.shape[2:], frame.dtype)
+
+		gsframe = cv2.resize(gsframe, scaled_size, dst=gsframe_small, interpolation=cv2.INTER_AREA)
+
+	gsframe = clahe.apply(gsframe)
 
-	# Calculate frame darkness
-	darkness = (hist[0] / hist_total * 100)
+	# Calculate frame darkness, the share of pixels in the lowest of 8 histogram bins
+	darkness, pixel_total = frame_darkness(gsframe)
 
 	# If the image is fully black due to a bad camera read,
 	# skip to the next frame
-	if (hist_total == 0) or (darkness == 100):
+	if (pixel_total == 0) or (darkness == 100):
 		black_tries += 1
 		continue
 
@@ -321,9 +357,8 @@ while True:
 
 	# If the height is too high
 	if scaling_factor != 1:
-		# Apply that factor to the frame
-		frame = cv2.resize(frame, None, fx=scaling_factor, fy=scaling_factor, interpolation=cv2.INTER_AREA)
-		gsframe = cv2.resize(gsframe, None, fx=scaling_factor, fy=scaling_factor, interpolation=cv2.INTER_AREA)
+		# Apply that factor to the color frame as well
+		frame = cv2.resize(frame, scaled_size, dst=frame_small, interpolation=cv2.INTER_AREA)
 
 	# If camera is configured to rotate = 1, check portrait in addition to landscape
 	if rotate == 1:
@@ -343,50 +378,50 @@ while True:
 			frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
 			gsframe = cv2.rotate(gsframe, cv2.ROTATE_90_CLOCKWISE)
 
-	# Get all faces from that frame as encodings
-	# Use daemon if available, otherwise fallback to direct detection
+	# Get all faces from that frame together with their encodings
+	# Use daemon if available, it detects and encodes in a single request,
+	# otherwise fallback to direct detection
+	daemon_faces = False
 	if daemon_client and DAEMON_AVAILABLE:
-		try:
-			face_locations = daemon_client.detect_faces(gsframe)
-		except Exception as e:
-			print(_("Daemon detection failed, using fallback: {}").format(str(e)))
-			face_locations = face_detector(gsframe, 1)
-	else:
+		faces = daemon_client.detect_and_encode(frame, gsframe)
+		if faces is None:
+			# The daemon failed or did not answer in time, detect locally from now on
+			print(_("Daemon detection failed, using fallback"))
+			daemon_client.close()
+			daemon_client = None
+			if not load_models():
+				exit(1)
+		else:
+			daemon_faces = True
+
+	if not daemon_faces:
 		# Upsamples 1 time
-		face_locations = face_detector(gsframe, 1)
+		faces = [(fl, None) for fl in face_detector(gsframe, 1)]
 	
 	# Loop through each face
-	for fl in face_locations:
-		if use_cnn and not daemon_client:
+	for fl, face_encoding in faces:
+		if use_cnn and not daemon_faces:
 			fl = fl.rect
 
-		# Get face encoding using daemon or direct computation
-		if daemon_client and DAEMON_AVAILABLE:
-			try:
-				face_encoding = daemon_client.get_face_encoding(frame, fl)
-				if face_encoding is None:
+		# Use the encoding computed by the daemon or compute it directly
+		if daemon_faces:
+			# Skip faces the daemon could not encode
+			if face_encoding is None:
+				continue
+			face_encoding = np.asarray(face_encoding, dtype=np.float32)
+
+			# Get landmarks for liveness detection if needed
+			if liveness_detector:
+				# Request landmarks from daemon, a face that can't be checked is not matched
+				face_landmark = daemon_client.get_face_landmarks(frame, fl)
+				if face_landmark is None:
 					continue
-				face_encoding = np.array(face_encoding)
-				
-				# Get landmarks for liveness detection if needed
-				if liveness_detector:
-					# Request landmarks from daemon
-					face_landmark = daemon_client.send_request({
-						'type': 'get_face_landmarks',
-						'frame': frame,
-						'face_location': fl
-					})
-			except Exception as e:
-				print(_("Daemon encoding failed, using fallback: {}").format(str(e)))
-				face_landmark = pose_predictor(frame, fl)
-				face_encoding = np.array(face_encoder.compute_face_descriptor(frame, face_landmark, 1))
 		else:
-			# Fallback to direct computation
 			face_landmark = pose_predictor(frame, fl)
-			face_encoding = np.array(face_encoder.compute_face_descriptor(frame, face_landmark, 1))
+			face_encoding = np.array(face_encoder.compute_face_descriptor(frame, face_landmark, 1), dtype=np.float32)
 
 		# Liveness detection if enabled
-		if liveness_detector and face_landmark:
+		if liveness_detector and face_landmark is not None:
 			# Convert face location to region format for liveness detection
 			if hasattr(fl, 'left'):
 				face_region = (fl.left(), fl.top(), fl.width(), fl.height())
@@ -397,20 +432,18 @@ while True:
 			# process_frame handles both passive analysis and active challenges
 			is_live = liveness_detector.process_frame(frame, face_landmark, face_region)
 			
-			# Update UI with liveness feedback (active challenge instructions)
+			# Update UI with liveness feedback (active challenge instructions) when it changes
 			feedback = liveness_detector.get_user_feedback()
-			send_to_ui("M", feedback)
+			if feedback != last_feedback:
+				send_to_ui("M", feedback)
+				last_feedback = feedback
 			
 			if not is_live:
 				# Don't proceed to matching if liveness check hasn't passed
 				continue
 
-		# Match this found face against a known face
-		matches = np.linalg.norm(encodings - face_encoding, axis=1)
-
-		# Get best match
-		match_index = np.argmin(matches)
-		match = matches[match_index]
+		# Match this found face against a known face and get the best match
+		match_index, match = best_match(encodings, face_encoding)
 
 		# Update certainty if we have a new low
 		if lowest_certainty > match:
@@ -4,10 +4,13 @@ Frequency Analysis Module for Howdy
 Detects screen moire patterns using FFT (Fast Fourier Transform) to prevent 2D spoofing attacks.
 """
 
+import logging
 import cv2
 import numpy as np
 from i18n import _
 
+log = logging.getLogger("howdy.liveness")
+
 class FrequencyAnalyzer:
     def __init__(self, config=None):
         self.config = config
@@ -18,7 +21,30 @@ class FrequencyAnalyzer:
         else:
             self.moire_threshold = 0.15
             
-        self.input_size = (128, 128) # Fixed size for FFT consistency
+        # FFT implementation for the fft method: "opencv" (cv2.dft, SIMD vectorized) or "numpy"
+        if config:
+            self.fft_backend = config.get("security", "fft_backend", fallback="opencv")
+        else:
+            self.fft_backend = "opencv"
+
+        self._error_logged = False
+
+        self.input_size = (128, 128) # Fixed size for consistent analysis, already an optimal DFT size
+
+        # Reused destination for the resized face crop
+        self._resized = np.empty(self.input_size[::-1], np.uint8)
+
+        # Single precision input for the real-valued FFT
+        self._fft_input = np.empty(self._resized.shape, np.float32)
+
+        # Mask out low frequencies (natural features), built once on the native rfft2 layout:
+        # DC sits in the corner and negative row frequencies wrap around, so no fftshift is needed
+        rows, cols = self._resized.shape
+        mask_radius = 15
+        row_freqs = np.fft.fftfreq(rows) * rows
+        col_freqs = np.arange(cols // 2 + 1)
+        radius = np.hypot(row_freqs[:, None], col_freqs[None, :])
+        self._high_freq_mask = (radius > mask_radius).astype(np.float32)
 
     def analyze(self, frame, face_location=None):
         """
@@ -54,59 +80,70 @@ class FrequencyAnalyzer:
             else:
                 gray = roi
 
-            # Resize for consistent FFT analysis
-            gray_resized = cv2.resize(gray, self.input_size, interpolation=cv2.INTER_AREA)
+            # Resize for consistent analysis
+            gray_resized = cv2.resize(gray, self.input_size, dst=self._resized, interpolation=cv2.INTER_AREA)
 
-            # Apply FFT
-            f = np.fft.fft2(gray_resized)
-            fshift = np.fft.fftshift(f)
-            magnitude_spectrum = 20 * np.log(np.abs(fshift) + 1e-10)
+            ratio = self._fft_ratio(gray_resized)
+            # These constants might need tuning based on camera hardware
+            base_ratio = 3.5
+            scale_factor = 2.0
 
-            # Analyze high frequencies vs low frequencies
-            # Moire patterns often show up as distinct spikes in high frequencies
-            
-            rows, cols = gray_resized.shape
-            crow, ccol = rows // 2, cols // 2
-            
-            # Mask for center (low frequencies - natural features)
-            mask_radius = 15
-            mask = np.ones((rows, cols), np.uint8)
-            cv2.circle(mask, (ccol, crow), mask_radius, 0, -1)
-            
-            # Extract high frequency components
-            high_freq_magnitude = magnitude_spectrum * mask
-            
-            # Calculate energy stats
-            mean_energy = np.mean(high_freq_magnitude)
-            max_energy = np.max(high_freq_magnitude)
-            
-            # Heuristic: Artificial screens often have higher peak energy in high freqs
-            # compared to natural skin texture.
-            # Normalize score: simple heuristic based on max/mean ratio
-            
-            # Avoid division by zero
-            if mean_energy == 0:
+            if ratio is None:
                 return 0.0
 
-            ratio = max_energy / (mean_energy + 1e-5)
-            
-            # Normalize to 0-1 range based on observed thresholds
-            # Natural faces usually have lower ratios (smoother spectrum falloff)
-            # Screens have higher ratios (spikes)
-            
-            # These constants might need tuning based on camera hardware
-            base_ratio = 3.5 
-            scale_factor = 2.0
-            
             score = 1.0 / (1.0 + np.exp(-(ratio - base_ratio) * scale_factor))
             
             # Cap at 1.0
             return min(1.0, max(0.0, score))
 
         except Exception as e:
-            print(f"Error in Frequency Analysis: {e}")
+            # A failure usually repeats on every frame, only the first one is shown,
+            # the rest go to the debug log
+            if not self._error_logged:
+                print(f"Error in Frequency Analysis: {e}")
+                self._error_logged = True
+            else:
+                log.debug("Error in Frequency Analysis: %s", e)
             return 0.0
 
+    def _fft_ratio(self, gray):
+        """Peak to mean ratio of the high frequency part of the spectrum"""
+        # Apply a float32 FFT of the real input, only the non-redundant half of the spectrum is used
+        np.copyto(self._fft_input, gray)
+        if self.fft_backend == "numpy":
+            f = np.fft.rfft2(self._fft_input)
+            re, im = f.real, f.imag
+        else:
+            f = cv2.dft(self._fft_input, flags=cv2.DFT_COMPLEX_OUTPUT)[:, :self._high_freq_mask.shape[1]]
+            re, im = f[:, :, 0], f[:, :, 1]
+
+        # Log power spectrum: |F|^2 needs no square root and log1p needs no epsilon.
+        # log1p(|F|^2) is about 2 * log(|F|), so the peak to mean ratio below keeps its scale
+        magnitude_spectrum = re * re
+        magnitude_spectrum += im * im
+        np.log1p(magnitude_spectrum, out=magnitude_spectrum)
+
+        # Analyze high frequencies vs low frequencies
+        # Moire patterns often show up as distinct spikes in high frequencies
+
+        # Extract high frequency components
+        high_freq_magnitude = np.multiply(magnitude_spectrum, self._high_freq_mask, out=magnitude_spectrum)
+
+        # Calculate energy stats
+        mean_energy = np.mean(high_freq_magnitude)
+        max_energy = np.max(high_freq_magnitude)
+
+        # Heuristic: Artificial screens often have higher peak energy in high freqs
+        # compared to natural skin texture.
+        # Natural faces usually have lower ratios (smoother spectrum falloff)
+        # Screens have higher ratios (spikes)
+
+        # Avoid division by zero
+        if mean_energy == 0:
+            return None
+
+        return float(max_energy / (mean_energy + 1e-5))
+
     def is_spoof(self, score):
         """Returns True if score exceeds threshold"""
         return score > self.moire_threshold
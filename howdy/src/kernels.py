@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Numerical kernels for Howdy hot paths
+Single pass NumPy/OpenCV reductions for face matching, liveness and frame quality checks.
+"""
+
+import math
+
+import cv2
+import numpy as np
+
+
+def _best_match(encodings, face_encoding):
+    """Squared distances to every known encoding, then the smallest one"""
+    diff = encodings - face_encoding
+    # Row-wise dot product squares and sums in one pass without a squared temporary
+    distances = np.einsum("ij,ij->i", diff, diff)
+    best_index = distances.argmin()
+    return best_index, distances[best_index]
+
+
+def eye_aspect_ratio(eye_points):
+    """
+    Eye Aspect Ratio of one eye, from its 6 landmark points as a (6, 2) array.
+    Returns 0.0 if the eye corners coincide.
+    """
+    # Vertical point pairs (A, B) and the horizontal pair (C)
+    ax = float(eye_points[1, 0] - eye_points[5, 0])
+    ay = float(eye_points[1, 1] - eye_points[5, 1])
+    bx = float(eye_points[2, 0] - eye_points[4, 0])
+    by = float(eye_points[2, 1] - eye_points[4, 1])
+    cx = float(eye_points[0, 0] - eye_points[3, 0])
+    cy = float(eye_points[0, 1] - eye_points[3, 1])
+
+    c = math.sqrt(cx * cx + cy * cy)
+    if c == 0.0:
+        return 0.0
+    return (math.sqrt(ax * ax + ay * ay) + math.sqrt(bx * bx + by * by)) / (2.0 * c)
+
+
+def head_turn_ratio(landmarks):
+    """
+    Horizontal position of the nose tip within the face width, from all 68 landmark points.
+    0.5 is centered, 0.5 is also returned if the face has no width.
+    """
+    left_face = landmarks[0, 0]
+    face_width = landmarks[16, 0] - left_face
+    if face_width == 0:
+        return 0.5
+    return float(landmarks[30, 0] - left_face) / float(face_width)
+
+
+def value_range(values):
+    """Peak to peak range of a 1D array, 0.0 if it is empty"""
+    if values.shape[0] == 0:
+        return 0.0
+    return float(values.max() - values.min())
+
+
+def best_match(encodings, face_encoding):
+    """
+    Find the known encoding closest to face_encoding.
+    Returns a tuple of (index, euclidean distance).
+    """
+    encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+    face_encoding = np.ascontiguousarray(face_encoding, dtype=np.float32)
+
+    index, distance = _best_match(encodings, face_encoding)
+    # Only the winner needs the square root, the search works on squared distances
+    return int(index), float(np.sqrt(distance))
+
+
+def frame_darkness(gsframe):
+    """
+    Percentage of dark pixels in a grayscale frame, matching the first bin of an
+    8 bin histogram. Returns a tuple of (darkness, total pixel count).
+    """
+    # Only the first channel counts if the grayscale conversion failed
+    if gsframe.ndim == 3:
+        gsframe = gsframe[:, :, 0]
+
+    total = gsframe.size
+    if total == 0:
+        return 0.0, 0
+
+    # Pixels in the lowest of 8 histogram bins (0-31), counted on OpenCV's SIMD paths
+    dark = cv2.countNonZero(cv2.compare(gsframe, 32, cv2.CMP_LT))
+    return dark * 100.0 / total, total
+
+
+def _rect_sum(integral, top, bottom, left, right):
+    """Sum of the pixels in [top, bottom) x [left, right) from an integral image"""
+    return integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+
+
+def gray_statistics(gray, integral=None):
+    """
+    Quality statistics of a grayscale frame: Laplacian variance (blur score), mean
+    brightness, contrast (standard deviation) and the mean brightness of the top left,
+    top right, bottom left and bottom right quadrants.
+    integral is an optional (height + 1, width + 1) int32 buffer for the integral image,
+    so repeated calls on same sized frames don't allocate it.
+    """
+    height, width = gray.shape
+    half_height = height // 2
+    half_width = width // 2
+
+    # The 3x3 Laplacian of 8 bit pixels stays within +-1020, so 16 bit integers hold it
+    # exactly at a quarter of the bandwidth of CV_64F. Its variance is the squared stddev
+    _, blur_stddev = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_16S))
+    blur_score = blur_stddev[0, 0] ** 2
+    # Mean and standard deviation in one SIMD pass
+    mean, stddev = cv2.meanStdDev(gray)
+    brightness = mean[0, 0]
+    contrast = stddev[0, 0]
+
+    # Every quadrant sum is 4 lookups into the integral image
+    integral = cv2.integral(gray, integral)
+    quadrant_sums = [
+        _rect_sum(integral, 0, half_height, 0, half_width),
+        _rect_sum(integral, 0, half_height, half_width, width),
+        _rect_sum(integral, half_height, height, 0, half_width),
+        _rect_sum(integral, half_height, height, half_width, width)
+    ]
+
+    areas = (
+        half_height * half_width,
+        half_height * (width - half_width),
+        (height - half_height) * half_width,
+        (height - half_height) * (width - half_width)
+    )
+    quadrant_means = tuple(
+        float(quadrant_sum) / area if area else 0.0
+        for quadrant_sum, area in zip(quadrant_sums, areas)
+    )
+
+    return float(blur_score), float(brightness), float(contrast), quadrant_means
+
+
+class RingBuffer:
+    """Fixed size history backed by a NumPy array, the oldest value is overwritten when full"""
+
+    def __init__(self, size, dtype=np.float32):
+        self.buffer = np.zeros(size, dtype=dtype)
+        self._scratch = np.empty(size, dtype=dtype)
+        self.size = size
+        self.index = 0 # Next write position
+        self.filled = 0
+
+    def __len__(self):
+        return self.filled
+
+    def append(self, value):
+        """Store a value, overwriting the oldest one if the buffer is full"""
+        self.buffer[self.index] = value
+        self.index = (self.index + 1) % self.size
+        if self.filled < self.size:
+            self.filled += 1
+
+    def clear(self):
+        """Forget all stored values"""
+        self.index = 0
+        self.filled = 0
+
+    def values(self):
+        """All stored values in storage order, as a view for order independent reductions"""
+        return self.buffer[:self.filled]
+
+    def last(self, count):
+        """
+        The most recent values, oldest first, as one contiguous array.
+        It is only valid until the buffer changes.
+        """
+        count = min(count, self.filled)
+        start = self.index - count
+        if start >= 0:
+            return self.buffer[start:self.index]
+
+        # The values wrap around the end, join both parts in the scratch array
+        result = self._scratch[:count]
+        result[:-start] = self.buffer[start:]
+        result[-start:] = self.buffer[:self.index]
+        return result
@@ -8,10 +8,13 @@ import cv2
 import numpy as np
 import time
 import dlib
-from collections import deque
 import math
 import random
+import queue
+import threading
+from dataclasses import dataclass
 from i18n import _
+from kernels import RingBuffer, eye_aspect_ratio, head_turn_ratio, value_range
 
 # Import new analysis modules
 try:
@@ -19,85 +22,130 @@ try:
 except ImportError:
     FrequencyAnalyzer = None
 
+@dataclass(frozen=True)
+class LivenessConfig:
+    """Liveness settings from the [security] section, parsed once per detector"""
+    security_level: str = "medium"
+    active_challenge: bool = True
+    frequency_analysis: bool = True
+    temporal_analysis: bool = True
+    challenge_timeout: float = 3.0
+    min_consistency_frames: int = 5
+
+def load_liveness_config(config=None):
+    """Read the LivenessConfig from a config object, defaults if there is none"""
+    if not config:
+        return LivenessConfig()
+        
+    return LivenessConfig(
+        security_level=config.get("security", "security_level", fallback="medium"),
+        active_challenge=config.getboolean("security", "active_challenge", fallback=True),
+        frequency_analysis=config.getboolean("security", "frequency_analysis", fallback=True),
+        temporal_analysis=config.getboolean("security", "temporal_analysis", fallback=True),
+        challenge_timeout=config.getfloat("security", "challenge_timeout", fallback=3.0),
+        min_consistency_frames=config.getint("security", "min_consistency_frames", fallback=5),
+    )
+
+def _drain(items):
+    """Take everything currently in a queue without blocking"""
+    drained = []
+    while True:
+        try:
+            drained.append(items.get_nowait())
+        except queue.Empty:
+            return drained
+
+
 class ActiveChallengeSystem:
     """Manages active challenges for the user (blink, turn head, etc)"""
     
     CHALLENGE_TYPES = ['blink', 'turn_left', 'turn_right', 'nod']
     
-    def __init__(self, config=None):
+    def __init__(self, config=None, settings=None):
         self.config = config
+        if settings is None:
+            settings = load_liveness_config(config)
         self.current_challenge = None
         self.challenge_start_time = 0
-        self.challenge_timeout = 3.0
-        
-        if config:
-            self.challenge_timeout = config.getfloat("security", "challenge_timeout", fallback=3.0)
+        self.challenge_timeout = settings.challenge_timeout
             
         self.completed_challenges = set()
         self.state = 'IDLE' # IDLE, WAITING_FOR_ACTION, VERIFIED, FAILED
+        self.reset()
+        
+        # UI messages by (state, challenge), translated once instead of on every poll
+        self._ui_messages = {
+            ('IDLE', None): _("Checking liveness..."),
+            ('VERIFIED', None): _("Liveness Confirmed"),
+            ('FAILED', None): _("Liveness Check Failed"),
+            ('WAITING_FOR_ACTION', 'blink'): _("PLEASE BLINK EYES"),
+            ('WAITING_FOR_ACTION', 'turn_left'): _("TURN HEAD LEFT <<"),
+            ('WAITING_FOR_ACTION', 'turn_right'): _("TURN HEAD RIGHT >>"),
+            ('WAITING_FOR_ACTION', 'nod'): _("NOD HEAD UP/DOWN"),
+        }
+        self._default_ui_message = _("...")
+        
+    def reset(self):
+        """Forget completed challenges and shuffle the order for a new session"""
+        self.state = 'IDLE'
+        self.completed_challenges.clear()
+        # Each challenge is drawn at most once per session, so one shuffle replaces a pick per challenge
+        self._challenge_order = list(self.CHALLENGE_TYPES)
+        random.shuffle(self._challenge_order)
         
-    def start_random_challenge(self):
+    def start_random_challenge(self, now=None):
         """Starts a new random challenge that hasn't been completed yet"""
-        available = [c for c in self.CHALLENGE_TYPES if c not in self.completed_challenges]
-        if not available:
+        if not self._challenge_order:
             # If all done (or just one needed), verify
             self.state = 'VERIFIED'
             return None
             
-        self.current_challenge = random.choice(available)
-        self.challenge_start_time = time.time()
+        self.current_challenge = self._challenge_order.pop()
+        self.challenge_start_time = time.time() if now is None else now
         self.state = 'WAITING_FOR_ACTION'
         return self.current_challenge
         
     def get_ui_message(self):
         """Returns message to display to user"""
-        if self.state == 'IDLE':
-            return _("Checking liveness...")
-        elif self.state == 'VERIFIED':
-            return _("Liveness Confirmed")
-        elif self.state == 'FAILED':
-            return _("Liveness Check Failed")
-            
-        if self.current_challenge == 'blink':
-            return _("PLEASE BLINK EYES")
-        elif self.current_challenge == 'turn_left':
-            return _("TURN HEAD LEFT <<")
-        elif self.current_challenge == 'turn_right':
-            return _("TURN HEAD RIGHT >>")
-        elif self.current_challenge == 'nod':
-            return _("NOD HEAD UP/DOWN")
-            
-        return _("...")
+        challenge = self.current_challenge if self.state == 'WAITING_FOR_ACTION' else None
+        return self._ui_messages.get((self.state, challenge), self._default_ui_message)
 
 class AdvancedLivenessDetector:
     """Enhanced Liveness Detector with Active Challenges"""
     
+    # Landmark indices of the 68 point model. Contiguous ranges are kept as slices so
+    # the eye points are views instead of gather copies
+    LEFT_EYE = slice(36, 42)
+    RIGHT_EYE = slice(42, 48)
+    NOSE_TIP = 30
+    
     def __init__(self, config=None):
         self.config = config
         
         # --- Config Values ---
-        self.security_level = config.get("security", "security_level", fallback="medium")
-        self.use_active_challenge = config.getboolean("security", "active_challenge", fallback=True)
-        self.use_frequency = config.getboolean("security", "frequency_analysis", fallback=True)
-        self.use_temporal = config.getboolean("security", "temporal_analysis", fallback=True)
+        settings = load_liveness_config(config)
+        self.security_level = settings.security_level
+        self.use_active_challenge = settings.active_challenge
+        self.use_frequency = settings.frequency_analysis
+        self.use_temporal = settings.temporal_analysis
         
         # --- Sub-systems ---
-        self.challenge_system = ActiveChallengeSystem(config) if self.use_active_challenge else None
+        self.challenge_system = ActiveChallengeSystem(config, settings) if self.use_active_challenge else None
         self.frequency_analyzer = FrequencyAnalyzer(config) if (self.use_frequency and FrequencyAnalyzer) else None
         
         # --- State Tracking ---
         # Blink
-        self.eye_ar_threshold = 0.25
-        self.eye_ar_history = deque(maxlen=30)
+        self.eye_ar_threshold = 0.25 # Below this the eyes count as closed
+        self.eye_ar_open_threshold = 0.3 # Above this the eyes count as open
+        self._blink_state = None # None until the eyes are first seen open, then 'OPEN' or 'CLOSED'
         self.blink_detected = False
         
         # Head Movement
-        self.head_positions = deque(maxlen=20)
+        self.head_positions = RingBuffer(20)
         self.initial_head_pose = None
         
         # Temporal Consistency (Anti-Replay)
-        self.frame_diff_history = deque(maxlen=10)
-        self.min_consistency_frames = config.getint("security", "min_consistency_frames", fallback=5)
+        self.min_consistency_frames = settings.min_consistency_frames
         
         # Timers
         self.start_time = None
@@ -107,65 +155,93 @@ class AdvancedLivenessDetector:
         # Stats
         self.spoof_score = 0.0 # 0.0 = Real, 1.0 = Fake
         
+        # Frequency analysis runs on a background thread so it never holds up the challenge checks.
+        # Only one frame waits at a time, frames arriving while it is busy are skipped.
+        # Scores come back through a second queue, tagged with the session they belong to
+        self._freq_queue = queue.Queue(maxsize=1)
+        self._freq_results = queue.SimpleQueue()
+        self._freq_session = 0
+        if self.frequency_analyzer:
+            threading.Thread(target=self._frequency_worker, daemon=True).start()
+            
+        # Motion gate: a face that has not moved since the last analyzed frame gives the same
+        # frequency score, so it is not analyzed again within motion_window seconds
+        self.motion_threshold = 1.5 # Mean absolute difference of the 32x32 face thumbnail
+        self.motion_window = 0.1
+        self._prev_crop = None
+        self._last_freq_submit = 0
+        
     def reset(self):
         """Reset state for new session"""
-        self.eye_ar_history.clear()
+        self._blink_state = None
         self.head_positions.clear()
-        self.frame_diff_history.clear()
         self.blink_detected = False
         self.initial_head_pose = None
         self.start_time = time.time()
         self.spoof_score = 0.0
+        # Frames and scores of the previous session must not count towards this one
+        self._freq_session += 1
+        _drain(self._freq_queue)
+        _drain(self._freq_results)
+        self._prev_crop = None
+        self._last_freq_submit = 0
         
         if self.challenge_system:
-            self.challenge_system.state = 'IDLE'
-            self.challenge_system.completed_challenges.clear()
+            self.challenge_system.reset()
             # Start first challenge immediately for smoother UX
             self.challenge_system.start_random_challenge()
 
-    def _get_ear(self, eye_points):
-        """Calculate Eye Aspect Ratio"""
-        # Distances between vertical points
-        A = np.linalg.norm(np.array(eye_points[1]) - np.array(eye_points[5]))
-        B = np.linalg.norm(np.array(eye_points[2]) - np.array(eye_points[4]))
-        # Distance between horizontal points
-        C = np.linalg.norm(np.array(eye_points[0]) - np.array(eye_points[3]))
-        if C == 0: return 0
-        return (A + B) / (2.0 * C)
+    def _frequency_worker(self):
+        """Analyze the most recently submitted frame and publish its score"""
+        while True:
+            session, frame, face_region = self._freq_queue.get()
+            self._freq_results.put((session, self.frequency_analyzer.analyze(frame, face_region)))
+
+    def _face_moved(self, gray, face_region, now):
+        """Compare a small thumbnail of the face with the previous frame's one"""
+        if hasattr(face_region, 'left'):
+            x, y, w, h = face_region.left(), face_region.top(), face_region.width(), face_region.height()
+        else:
+            x, y, w, h = face_region
+        x, y = max(0, x), max(0, y)
+        face = gray[y:y+h, x:x+w]
+        if face.size == 0:
+            return True
+            
+        crop = cv2.resize(face, (32, 32), interpolation=cv2.INTER_AREA)
+        prev_crop, self._prev_crop = self._prev_crop, crop
+        if prev_crop is None or now - self._last_freq_submit >= self.motion_window:
+            return True
+            
+        return cv2.absdiff(prev_crop, crop).mean() >= self.motion_threshold
+
+    def _landmarks_to_np(self, landmarks):
+        """Read all landmark coordinates from dlib once, as an (N, 2) int32 array"""
+        # The model daemon already sends them as one
+        if isinstance(landmarks, np.ndarray):
+            return landmarks
+        return np.array([(point.x, point.y) for point in landmarks.parts()], dtype=np.int32)
 
-    def _check_blink(self, landmarks):
+    def _check_blink(self, lm_np):
         """Detect blink from landmarks"""
-        left_eye = [(landmarks.part(i).x, landmarks.part(i).y) for i in range(36, 42)]
-        right_eye = [(landmarks.part(i).x, landmarks.part(i).y) for i in range(42, 48)]
-        
-        left_ear = self._get_ear(left_eye)
-        right_ear = self._get_ear(right_eye)
+        left_ear = eye_aspect_ratio(lm_np[self.LEFT_EYE])
+        right_ear = eye_aspect_ratio(lm_np[self.RIGHT_EYE])
         avg_ear = (left_ear + right_ear) / 2.0
         
-        self.eye_ar_history.append(avg_ear)
-        
-        # Simple blink logic: transition from open -> closed -> open
-        if len(self.eye_ar_history) >= 3:
-            # If current is closed but recent history was open
-            if avg_ear < self.eye_ar_threshold:
-                # Check if we were open recently
-                if max(list(self.eye_ar_history)[-5:]) > 0.3:
-                    return True
+        # A blink is the transition open -> closed -> open, values between the thresholds keep the state
+        if avg_ear > self.eye_ar_open_threshold:
+            was_closed = self._blink_state == 'CLOSED'
+            self._blink_state = 'OPEN'
+            return was_closed
+        if avg_ear < self.eye_ar_threshold and self._blink_state == 'OPEN':
+            self._blink_state = 'CLOSED'
         return False
 
-    def _check_head_turn(self, landmarks, direction):
+    def _check_head_turn(self, lm_np, direction):
         """Check if head is turned in specific direction"""
-        nose_tip = landmarks.part(30).x
-        chin = landmarks.part(8).x
-        left_face = landmarks.part(0).x
-        right_face = landmarks.part(16).x
-        
-        face_width = right_face - left_face
-        if face_width == 0: return False
-        
         # Ratio of nose position within face width
         # 0.5 = center, < 0.5 = left (from viewer perspective, right for user), > 0.5 = right
-        ratio = (nose_tip - left_face) / face_width
+        ratio = head_turn_ratio(lm_np)
         
         if direction == 'turn_left': # User turns left (viewer sees nose move right)
             return ratio > 0.65
@@ -174,9 +250,9 @@ class AdvancedLivenessDetector:
             
         return False
         
-    def _check_nod(self, landmarks):
+    def _check_nod(self, lm_np):
         """Check for nodding motion"""
-        nose_tip_y = landmarks.part(30).y
+        nose_tip_y = int(lm_np[self.NOSE_TIP, 1])
         
         if not self.head_positions:
             self.head_positions.append(nose_tip_y)
@@ -187,7 +263,7 @@ class AdvancedLivenessDetector:
         
         # Check variance in Y axis
         if len(self.head_positions) >= 5:
-            y_range = max(self.head_positions) - min(self.head_positions)
+            y_range = value_range(self.head_positions.values())
             return y_range > 15 # Threshold in pixels
             
         return False
@@ -200,14 +276,35 @@ class AdvancedLivenessDetector:
         if not self.start_time:
             self.reset()
             
-        elapsed = time.time() - self.start_time
+        # Single clock reading shared by every timer check in this frame
+        now = time.time()
+        elapsed = now - self.start_time
         if elapsed > self.max_detection_time:
             return False # Timeout
+            
+        # Nothing left to check once the challenges have been decided
+        if self.challenge_system and self.challenge_system.state in ('VERIFIED', 'FAILED'):
+            return self.challenge_system.state == 'VERIFIED'
+
+        # Grayscale once per frame for the passive checks. cvtColor returns a new array,
+        # so the worker can hold on to it while the caller reuses its frame buffer
+        gray = None
+        if self.frequency_analyzer:
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame.copy()
 
         # 1. Frequency Analysis (Passive)
         if self.frequency_analyzer:
-            freq_score = self.frequency_analyzer.analyze(frame, face_region)
-            if self.frequency_analyzer.is_spoof(freq_score):
+            # Hand this frame to the worker if nothing is waiting yet and the face has changed.
+            # The challenge checks below still run on every frame so short blinks are not missed
+            if not self._freq_queue.full() and self._face_moved(gray, face_region, now):
+                self._freq_queue.put_nowait((self._freq_session, gray, face_region))
+                self._last_freq_submit = now
+            
+            # Every published score is counted once
+            for session, freq_score in _drain(self._freq_results):
+                if session != self._freq_session or not self.frequency_analyzer.is_spoof(freq_score):
+                    continue
+                # Shown on stdout, which the PAM module reads
                 print(f"Spoof detected (Frequency Analysis): {freq_score:.2f}")
                 self.spoof_score += 0.2
                 if self.spoof_score > 0.5:
@@ -222,14 +319,17 @@ class AdvancedLivenessDetector:
             challenge = self.challenge_system.current_challenge
             success = False
             
+            # Cross into dlib once per frame, the checks below only index the array
+            lm_np = self._landmarks_to_np(landmarks)
+            
             if challenge == 'blink':
-                if self._check_blink(landmarks):
+                if self._check_blink(lm_np):
                     success = True
             elif challenge in ['turn_left', 'turn_right']:
-                if self._check_head_turn(landmarks, challenge):
+                if self._check_head_turn(lm_np, challenge):
                     success = True
             elif challenge == 'nod':
-                if self._check_nod(landmarks):
+                if self._check_nod(lm_np):
                     success = True
             
             if success:
@@ -237,7 +337,7 @@ class AdvancedLivenessDetector:
                 # For now, 1 successful challenge is enough for medium security
                 if self.security_level == 'high':
                     if len(self.challenge_system.completed_challenges) < 2:
-                        self.challenge_system.start_random_challenge()
+                        self.challenge_system.start_random_challenge(now)
                     else:
                         self.challenge_system.state = 'VERIFIED'
                         return True
@@ -246,7 +346,7 @@ class AdvancedLivenessDetector:
                     return True
             
             # Check timeout for current challenge
-            if time.time() - self.challenge_system.challenge_start_time > self.challenge_system.challenge_timeout:
+            if now - self.challenge_system.challenge_start_time > self.challenge_system.challenge_timeout:
                 # Try one more challenge or fail?
                 # For UX, maybe just fail or fallback to passive if confidence high
                 pass
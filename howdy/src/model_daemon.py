@@ -7,6 +7,8 @@ import os
 import sys
 import time
 import json
+import tempfile
+import hashlib
 import threading
 import configparser
 import dlib
@@ -14,9 +16,18 @@ import numpy as np
 import paths_factory
 from i18n import _
 import socket
-import pickle
+import selectors
 import struct
 import signal
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 try:
     import daemon
@@ -26,6 +37,302 @@ except ImportError:
     DAEMON_MODULES_AVAILABLE = False
 
 
+def content_hash(data):
+    """Короткий хэш содержимого файла для проверки актуальности кэша"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def is_valid_username(username):
+    """
+    Имя пользователя из запроса подставляется в пути к файлам моделей и кэша,
+    поэтому допускается только непустое имя без разделителей каталогов и ".."
+    """
+    return (
+        isinstance(username, str) and username != ''
+        and os.sep not in username and (os.altsep is None or os.altsep not in username)
+        and '..' not in username and '\0' not in username
+    )
+
+
+# Заголовок файла дискового кэша энкодингов:
+# сигнатура, число энкодингов, размерность, хэш исходного файла модели
+CACHE_MAGIC = b'HOWDYEN2'
+_CACHE_HEADER = struct.Struct('<8sII16s')
+
+
+def recvall(sock, n):
+    """Получение точно n байт данных"""
+    # Данные принимаются сразу в выделенный буфер, без промежуточных bytes и расширения
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return data
+
+
+# Теги двоичного формата сообщений.
+# В отличие от pickle, при разборе создаются только данные, но не произвольные объекты
+TAG_NONE = b'N'
+TAG_TRUE = b'T'
+TAG_FALSE = b'F'
+TAG_INT = b'i'
+TAG_FLOAT = b'f'
+TAG_STR = b's'
+TAG_BYTES = b'b'
+TAG_LIST = b'l'
+TAG_TUPLE = b't'
+TAG_DICT = b'd'
+TAG_ARRAY = b'a'
+TAG_RECT = b'r'
+
+_U8 = struct.Struct('>B')
+_U32 = struct.Struct('>I')
+_I64 = struct.Struct('>q')
+_F64 = struct.Struct('>d')
+_RECT = struct.Struct('>4q')
+
+# Заголовок сообщения: номер запроса, длина заголовка значения, число буферов массивов
+_FRAME = struct.Struct('>III')
+
+
+def encode_value(value, out, buffers):
+    """
+    Запись значения в out в тегированном двоичном формате.
+    Данные массивов numpy не копируются в out, а добавляются в buffers
+    """
+    if value is None:
+        out += TAG_NONE
+    elif value is True:
+        out += TAG_TRUE
+    elif value is False:
+        out += TAG_FALSE
+    elif isinstance(value, int):
+        out += TAG_INT
+        out += _I64.pack(value)
+    elif isinstance(value, float):
+        out += TAG_FLOAT
+        out += _F64.pack(value)
+    elif isinstance(value, str):
+        data = value.encode()
+        out += TAG_STR
+        out += _U32.pack(len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray)):
+        out += TAG_BYTES
+        out += _U32.pack(len(value))
+        out += value
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        dtype = value.dtype.str.encode()
+        out += TAG_ARRAY
+        out += _U8.pack(len(dtype))
+        out += dtype
+        out += _U8.pack(value.ndim)
+        for size in value.shape:
+            out += _U32.pack(size)
+        buffers.append(value.reshape(-1).view(np.uint8))
+    elif isinstance(value, np.generic):
+        encode_value(value.item(), out, buffers)
+    elif isinstance(value, (list, tuple)):
+        out += TAG_LIST if isinstance(value, list) else TAG_TUPLE
+        out += _U32.pack(len(value))
+        for item in value:
+            encode_value(item, out, buffers)
+    elif isinstance(value, dict):
+        out += TAG_DICT
+        out += _U32.pack(len(value))
+        for key, item in value.items():
+            encode_value(key, out, buffers)
+            encode_value(item, out, buffers)
+    elif isinstance(value, dlib.rectangle):
+        out += TAG_RECT
+        out += _RECT.pack(value.left(), value.top(), value.right(), value.bottom())
+    else:
+        raise TypeError("Unsupported type in daemon message: {}".format(type(value).__name__))
+
+
+def decode_value(data, pos, buffers):
+    """Чтение значения, записанного encode_value, возвращает (значение, новая позиция)"""
+    tag = data[pos:pos + 1]
+    pos += 1
+    
+    if tag == TAG_NONE:
+        return None, pos
+    if tag == TAG_TRUE:
+        return True, pos
+    if tag == TAG_FALSE:
+        return False, pos
+    if tag == TAG_INT:
+        return _I64.unpack_from(data, pos)[0], pos + _I64.size
+    if tag == TAG_FLOAT:
+        return _F64.unpack_from(data, pos)[0], pos + _F64.size
+    if tag in (TAG_STR, TAG_BYTES):
+        length = _U32.unpack_from(data, pos)[0]
+        pos += _U32.size
+        value = bytes(data[pos:pos + length])
+        return (value.decode() if tag == TAG_STR else value), pos + length
+    if tag in (TAG_LIST, TAG_TUPLE):
+        count = _U32.unpack_from(data, pos)[0]
+        pos += _U32.size
+        items = []
+        for i in range(count):
+            item, pos = decode_value(data, pos, buffers)
+            items.append(item)
+        return (items if tag == TAG_LIST else tuple(items)), pos
+    if tag == TAG_DICT:
+        count = _U32.unpack_from(data, pos)[0]
+        pos += _U32.size
+        value = {}
+        for i in range(count):
+            key, pos = decode_value(data, pos, buffers)
+            value[key], pos = decode_value(data, pos, buffers)
+        return value, pos
+    if tag == TAG_ARRAY:
+        dtype_len = data[pos]
+        dtype = np.dtype(bytes(data[pos + 1:pos + 1 + dtype_len]).decode())
+        pos += 1 + dtype_len
+        if dtype.hasobject:
+            raise ValueError("Object arrays are not allowed in daemon messages")
+        ndim = data[pos]
+        pos += 1
+        shape = tuple(size for (size,) in _U32.iter_unpack(data[pos:pos + ndim * _U32.size]))
+        pos += ndim * _U32.size
+        # Массив создается поверх принятого буфера без копирования
+        return np.frombuffer(next(buffers), dtype=dtype).reshape(shape), pos
+    if tag == TAG_RECT:
+        return dlib.rectangle(*_RECT.unpack_from(data, pos)), pos + _RECT.size
+        
+    raise ValueError("Unknown tag in daemon message: {!r}".format(bytes(tag)))
+
+
+def encode_message(obj, request_id=0):
+    """
+    Кодирование объекта в сообщение без отправки.
+    Возвращает (заголовок, буферы массивов), TypeError если тип значения не поддерживается
+    """
+    header = bytearray()
+    buffers = []
+    encode_value(obj, header, buffers)
+    
+    # Заголовок сообщения, длина каждого буфера и заголовок значения одним вызовом
+    prefix = bytearray(_FRAME.size + _U32.size * len(buffers))
+    _FRAME.pack_into(prefix, 0, request_id, len(header), len(buffers))
+    for i, buffer in enumerate(buffers):
+        _U32.pack_into(prefix, _FRAME.size + _U32.size * i, buffer.nbytes)
+    return prefix + header, buffers
+
+
+def write_message(sock, message):
+    """Отправка сообщения, закодированного encode_message"""
+    header, buffers = message
+    sock.sendall(header)
+    for buffer in buffers:
+        sock.sendall(buffer)
+
+
+def send_message(sock, obj, request_id=0):
+    """
+    Отправка объекта через сокет.
+    Данные массивов numpy передаются отдельными буферами после заголовка,
+    без копирования в заголовок
+    """
+    write_message(sock, encode_message(obj, request_id))
+
+
+def recv_message(sock):
+    """
+    Получение объекта, отправленного send_message.
+    Возвращает (номер запроса, объект), EOFError если соединение закрыто
+    """
+    frame = recvall(sock, _FRAME.size)
+    if not frame:
+        raise EOFError
+    request_id, header_len, buffer_count = _FRAME.unpack(frame)
+    
+    # Длины буферов и заголовок значения идут подряд
+    sizes_len = _U32.size * buffer_count
+    data = recvall(sock, sizes_len + header_len)
+    if data is None:
+        raise EOFError
+    data = memoryview(data)
+    
+    buffers = [recvall(sock, size) for (size,) in _U32.iter_unpack(data[:sizes_len])]
+    if None in buffers:
+        raise EOFError
+    return request_id, decode_value(data[sizes_len:], 0, iter(buffers))[0]
+
+
+# Предел размера одной части сообщения (заголовка или буфера), принимаемого daemon
+MAX_MESSAGE_PART = 64 * 1024 * 1024
+
+
+class MessageReader:
+    """
+    Сборка сообщений send_message из сокета по частям, без ожидания данных.
+    Каждый вызов feed делает одно чтение, поэтому цикл событий не ждет медленных клиентов
+    """
+    
+    def __init__(self):
+        self._expect(_FRAME.size, self._frame_received)
+        
+    def _expect(self, size, handler):
+        """Ожидание следующей части сообщения размером size байт"""
+        if size > MAX_MESSAGE_PART:
+            raise ValueError(_("Message part too large: {} bytes").format(size))
+        self._data = bytearray(size)
+        self._view = memoryview(self._data)
+        self._received = 0
+        self._handler = handler
+        
+    def feed(self, sock):
+        """
+        Одно чтение из сокета, в котором есть данные.
+        Возвращает (номер запроса, объект) когда сообщение получено целиком, иначе None.
+        EOFError если соединение закрыто
+        """
+        if self._received < len(self._data):
+            count = sock.recv_into(self._view[self._received:])
+            if not count:
+                raise EOFError
+            self._received += count
+            
+        # Полученные части, в том числе пустые, разбираются сразу
+        while self._received == len(self._data):
+            message = self._handler()
+            if message is not None:
+                return message
+        return None
+        
+    def _frame_received(self):
+        self._request_id, header_len, buffer_count = _FRAME.unpack(self._data)
+        self._sizes_len = _U32.size * buffer_count
+        self._expect(self._sizes_len + header_len, self._header_received)
+        
+    def _header_received(self):
+        # Длины буферов и заголовок значения идут подряд
+        self._header = memoryview(self._data)
+        self._sizes = [size for (size,) in _U32.iter_unpack(self._header[:self._sizes_len])]
+        self._buffers = []
+        return self._next_buffer()
+        
+    def _buffer_received(self):
+        self._buffers.append(self._data)
+        return self._next_buffer()
+        
+    def _next_buffer(self):
+        if len(self._buffers) < len(self._sizes):
+            self._expect(self._sizes[len(self._buffers)], self._buffer_received)
+            return None
+            
+        message = (self._request_id, decode_value(self._header[self._sizes_len:], 0, iter(self._buffers))[0])
+        self._expect(_FRAME.size, self._frame_received)
+        return message
+
+
 class HowdyModelDaemon:
     """Daemon for preloading and caching face recognition models"""
     
@@ -49,12 +356,34 @@ class HowdyModelDaemon:
         self.models_loaded = False
         self.use_cnn = self.config.getboolean("core", "use_cnn", fallback=False)
         
+        # Двоичный кэш энкодингов на диске, после перезапуска читается через mmap без разбора JSON.
+        # Это вторая копия биометрических данных, поэтому по умолчанию выключен
+        self.disk_cache = self.config.getboolean("daemon", "disk_cache", fallback=False)
+        self.cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "howdy")
+        
+        # Буферы энкодингов, свои у каждого рабочего потока
+        self._thread_buffers = threading.local()
+        
+        # Максимальный размер батча для CNN детектора
+        self.detect_batch_size = 16
+        
         # IPC socket
         self.socket_path = "/tmp/howdy_daemon.sock"
         self.server_socket = None
         
-        # Thread safety lock
-        self.lock = threading.RLock()
+        # Число потоков для обработки запросов, dlib отпускает GIL во время вычислений
+        self.worker_count = 2
+        self.executor = None
+        self.selector = None
+        
+        # Ответы на запросы одного соединения могут отправляться из разных потоков.
+        # Клиент, который не читает ответы, задерживает поток не дольше send_timeout секунд
+        self._send_locks = {}
+        self.send_timeout = 5.0
+        
+        # Кэш энкодингов заменяется целиком при каждом изменении (copy-on-write),
+        # поэтому читается без блокировки. Блокировка нужна только для записи
+        self.lock = threading.Lock()
         
         # Statistics
         self.stats = {
@@ -64,6 +393,29 @@ class HowdyModelDaemon:
             'startup_time': 0,
             'average_response_time': 0
         }
+        
+        # Время ответа на последние запросы, среднее считается только по запросу статистики
+        self._response_times = deque(maxlen=1024)
+        
+        # Обработчики запросов по типу, поиск обработчика - одно обращение к словарю
+        self._dispatch = {
+            'get_encodings': self._get_encodings,
+            'detect_faces': lambda request: self.detect_faces(request.get('frame')),
+            'detect_faces_batch': lambda request: self.detect_faces_batch(request.get('frames')),
+            'get_face_encoding': lambda request: self.get_face_encoding(
+                request.get('frame'), request.get('face_location'), self.encoding_buffer(1)[0]
+            ),
+            'get_face_landmarks': lambda request: self.get_face_landmarks(
+                request.get('frame'), request.get('face_location')
+            ),
+            'detect_and_encode': lambda request: self.detect_and_encode(request.get('frame'), request.get('gsframe')),
+            'detect_and_encode_batch': lambda request: self.detect_and_encode_batch(
+                request.get('frames'), request.get('gsframes')
+            ),
+            'invalidate_cache': self._invalidate_cache,
+            'get_stats': self._get_stats,
+            'ping': lambda request: {'status': 'alive', 'models_loaded': self.models_loaded},
+        }
 
     def preload_models(self):
         """Предзагрузка всех dlib моделей в память"""
@@ -110,67 +462,216 @@ class HowdyModelDaemon:
 
     def load_user_encodings(self, username):
         """Загрузка и кэширование энкодингов пользователя"""
+        if not is_valid_username(username):
+            return None
+            
+        entry = self.encodings_cache.get(username)
+        if entry is not None:
+            self.stats['cache_hits'] += 1
+            return entry
+            
         with self.lock:
-            if username in self.encodings_cache:
+            # Энкодинги могли загрузить, пока поток ждал блокировку
+            entry = self.encodings_cache.get(username)
+            if entry is not None:
                 self.stats['cache_hits'] += 1
-                return self.encodings_cache[username]
+                return entry
                 
             try:
                 user_model_path = paths_factory.user_model_path(username)
                 if not os.path.exists(user_model_path):
+                    # Модели удалены, их копия в кэше тоже не должна остаться
+                    self.remove_disk_cache(username)
                     return None
                     
-                with open(user_model_path, 'r') as f:
-                    models = json.load(f)
-                
-                encodings = []
-                for model in models:
-                    encodings.extend(model["data"])
+                with open(user_model_path, 'rb') as f:
+                    file_stat = os.fstat(f.fileno())
+                    data = f.read()
+                data_hash = content_hash(data)
                 
-                # Преобразуем в numpy массив для быстрых вычислений
-                encodings_array = np.array(encodings)
+                cached = self.read_disk_cache(username, data_hash) if self.disk_cache else None
+                if cached:
+                    encodings_array, models = cached
+                else:
+                    models = orjson.loads(data) if ORJSON_AVAILABLE else json.loads(data)
+                    
+                    # Заполняем заранее выделенный непрерывный float32 массив напрямую,
+                    # без промежуточного списка всех энкодингов
+                    count = sum(len(model["data"]) for model in models)
+                    encodings_array = np.empty((count, 128), dtype=np.float32)
+                    row = 0
+                    for model in models:
+                        rows = len(model["data"])
+                        encodings_array[row:row + rows] = model["data"]
+                        # Данные модели ссылаются на свои строки общей матрицы вместо списков чисел
+                        model["data"] = encodings_array[row:row + rows]
+                        row += rows
+                        
+                    if self.disk_cache:
+                        self.write_disk_cache(username, data_hash, encodings_array, models)
                 
                 # Кэшируем результат
-                self.encodings_cache[username] = {
+                entry = {
                     'encodings': encodings_array,
                     'models': models,
-                    'last_modified': os.path.getmtime(user_model_path)
+                    'file_stat': (file_stat.st_size, file_stat.st_mtime_ns),
+                    'content_hash': data_hash
                 }
                 
+                self.encodings_cache = {**self.encodings_cache, username: entry}
                 self.stats['cache_misses'] += 1
-                return self.encodings_cache[username]
+                return entry
                 
             except Exception as e:
                 print(_("Error loading user encodings for {}: {}").format(username, str(e)))
                 return None
 
+    def disk_cache_path(self, username):
+        """Путь к файлу дискового кэша энкодингов пользователя, ValueError если он выходит за каталог кэша"""
+        cache_path = os.path.join(self.cache_dir, "{}.bin".format(username))
+        if not is_valid_username(username) or \
+                os.path.dirname(os.path.realpath(cache_path)) != os.path.realpath(self.cache_dir):
+            raise ValueError(_("Invalid username: {}").format(username))
+        return cache_path
+
+    def write_disk_cache(self, username, data_hash, encodings_array, models):
+        """
+        Запись энкодингов в дисковый кэш: заголовок, матрица float32
+        и описания моделей без данных в JSON
+        """
+        metadata = [
+            {**{key: value for key, value in model.items() if key != "data"}, "rows": len(model["data"])}
+            for model in models
+        ]
+        
+        try:
+            # Энкодинги - биометрические данные, кэш доступен только владельцу
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            cache_path = self.disk_cache_path(username)
+            
+            # Временный файл создается заново с уникальным именем (O_EXCL, права 0600),
+            # поэтому подложенная заранее ссылка не может перенаправить запись
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(_CACHE_HEADER.pack(CACHE_MAGIC, *encodings_array.shape, data_hash))
+                    f.write(encodings_array.astype('<f4', copy=False).tobytes())
+                    f.write(json.dumps(metadata).encode())
+                    
+                # Уже отображенный в память старый файл остается действителен до закрытия
+                os.replace(temp_path, cache_path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except (OSError, ValueError) as e:
+            print(_("Error writing encodings cache for {}: {}").format(username, str(e)))
+
+    def read_disk_cache(self, username, data_hash):
+        """
+        Чтение энкодингов из дискового кэша через mmap.
+        Возвращает (энкодинги, модели) или None если кэш отсутствует или устарел
+        """
+        try:
+            cache_path = self.disk_cache_path(username)
+            with open(cache_path, 'rb') as f:
+                magic, count, dim, cached_hash = _CACHE_HEADER.unpack(f.read(_CACHE_HEADER.size))
+                if magic != CACHE_MAGIC or cached_hash != data_hash:
+                    return None
+                    
+                # Метаданные моделей лежат после массивов
+                offset = _CACHE_HEADER.size + count * dim * 4
+                f.seek(offset)
+                metadata = json.loads(f.read())
+                
+            if count == 0:
+                return np.empty((0, dim), np.float32), metadata
+                
+            # Страницы матрицы читаются с диска по мере обращения
+            encodings_array = np.memmap(cache_path, dtype='<f4', mode='r', offset=_CACHE_HEADER.size, shape=(count, dim))
+        except (OSError, ValueError, struct.error):
+            return None
+            
+        row = 0
+        for model in metadata:
+            rows = model.pop("rows")
+            model["data"] = encodings_array[row:row + rows]
+            row += rows
+            
+        return encodings_array, metadata
+
+    def remove_disk_cache(self, username):
+        """Удаление дискового кэша энкодингов пользователя, если он есть"""
+        if not is_valid_username(username):
+            return
+            
+        try:
+            os.unlink(self.disk_cache_path(username))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(_("Error removing encodings cache for {}: {}").format(username, str(e)))
+
     def invalidate_user_cache(self, username):
         """Инвалидация кэша для конкретного пользователя"""
         with self.lock:
+            # Файл удаляется даже при выключенном disk_cache, он мог остаться с прошлого запуска
+            self.remove_disk_cache(username)
             if username in self.encodings_cache:
-                del self.encodings_cache[username]
+                encodings_cache = self.encodings_cache.copy()
+                del encodings_cache[username]
+                self.encodings_cache = encodings_cache
                 print(_("Cache invalidated for user: {}").format(username))
 
     def check_cache_validity(self, username):
         """Проверка актуальности кэша пользователя"""
-        if username not in self.encodings_cache:
+        if not is_valid_username(username):
+            return False
+            
+        entry = self.encodings_cache.get(username)
+        if entry is None:
             return False
             
         try:
             user_model_path = paths_factory.user_model_path(username)
-            current_mtime = os.path.getmtime(user_model_path)
-            cached_mtime = self.encodings_cache[username]['last_modified']
             
-            if current_mtime > cached_mtime:
-                self.invalidate_user_cache(username)
-                return False
+            # Размер и время изменения совпадают, файл не менялся
+            file_stat = os.stat(user_model_path)
+            if (file_stat.st_size, file_stat.st_mtime_ns) == entry['file_stat']:
+                return True
                 
-            return True
-        except:
+            # mtime ненадежен (сброс времени, копирование с -p, overlay),
+            # поэтому кэш сбрасывается только если изменилось содержимое
+            with open(user_model_path, 'rb') as f:
+                if content_hash(f.read()) == entry['content_hash']:
+                    # Запоминаем новые размер и время, чтобы не хэшировать файл снова
+                    with self.lock:
+                        if self.encodings_cache.get(username) is entry:
+                            entry = {**entry, 'file_stat': (file_stat.st_size, file_stat.st_mtime_ns)}
+                            self.encodings_cache = {**self.encodings_cache, username: entry}
+                    return True
+                    
+            self.invalidate_user_cache(username)
+            return False
+        except FileNotFoundError:
+            # Модели пользователя удалены, закэшированные энкодинги больше не должны совпадать
+            self.invalidate_user_cache(username)
+            return False
+        except OSError:
             return False
 
-    def get_face_encoding(self, frame, face_location):
-        """Получение энкодинга лица из кадра"""
+    def encoding_buffer(self, faces):
+        """
+        Буфер энкодингов текущего потока минимум на faces лиц.
+        Содержимое действительно до следующего запроса в этом потоке,
+        ответ успевает отправиться раньше
+        """
+        buffer = getattr(self._thread_buffers, 'encodings', None)
+        if buffer is None or len(buffer) < faces:
+            buffer = self._thread_buffers.encodings = np.empty((max(faces, 4), 128), dtype=np.float32)
+        return buffer
+
+    def get_face_encoding(self, frame, face_location, out=None):
+        """Получение энкодинга лица из кадра, в out если он передан"""
         if not self.models_loaded:
             return None
             
@@ -179,32 +680,86 @@ class HowdyModelDaemon:
             face_landmark = self.pose_predictor(frame, face_location)
             
             # Вычисляем энкодинг
-            face_encoding = np.array(
-                self.face_encoder.compute_face_descriptor(frame, face_landmark, 1)
-            )
-            
-            return face_encoding
+            descriptor = self.face_encoder.compute_face_descriptor(frame, face_landmark, 1)
+            if out is None:
+                return np.array(descriptor, dtype=np.float32)
+                
+            out[:] = descriptor
+            return out
         except Exception as e:
             print(_("Error computing face encoding: {}").format(str(e)))
             return None
 
+    def get_face_landmarks(self, frame, face_location):
+        """Ключевые точки лица как (N, 2) int32 массив координат"""
+        if not self.models_loaded:
+            return None
+            
+        try:
+            face_landmark = self.pose_predictor(frame, face_location)
+            return np.array([(point.x, point.y) for point in face_landmark.parts()], dtype=np.int32)
+        except Exception as e:
+            print(_("Error computing face landmarks: {}").format(str(e)))
+            return None
+
     def detect_faces(self, frame):
         """Детекция лиц в кадре"""
+        return self.detect_faces_batch([frame])[0]
+
+    def detect_faces_batch(self, frames):
+        """Детекция лиц в нескольких кадрах, список лиц для каждого кадра"""
         if not self.models_loaded:
-            return []
+            return [[] for frame in frames]
             
         try:
-            # Детекция лиц
-            face_locations = self.face_detector(frame, 1)
-            
-            # Преобразуем CNN результаты в обычный формат если нужно
-            if self.use_cnn:
-                face_locations = [fl.rect for fl in face_locations]
+            if not self.use_cnn:
+                # HOG детектор не поддерживает батчи
+                return [list(self.face_detector(frame, 1)) for frame in frames]
+                
+            # CNN детектор обрабатывает кадры одного размера за один проход,
+            # поэтому группируем кадры по размеру
+            groups = {}
+            for index, frame in enumerate(frames):
+                groups.setdefault(frame.shape, []).append(index)
                 
-            return face_locations
+            results = [None] * len(frames)
+            for indices in groups.values():
+                detections = self.face_detector(
+                    [frames[i] for i in indices], 1, batch_size=min(len(indices), self.detect_batch_size)
+                )
+                # Преобразуем CNN результаты в обычный формат
+                for i, face_locations in zip(indices, detections):
+                    results[i] = [fl.rect for fl in face_locations]
+                    
+            return results
         except Exception as e:
             print(_("Error detecting faces: {}").format(str(e)))
-            return []
+            return [[] for frame in frames]
+
+    def detect_and_encode(self, frame, gsframe):
+        """Детекция лиц и вычисление их энкодингов за один запрос"""
+        face_locations = self.detect_faces(gsframe)
+        buffer = self.encoding_buffer(len(face_locations))
+        return [
+            (face_location, self.get_face_encoding(frame, face_location, buffer[i]))
+            for i, face_location in enumerate(face_locations)
+        ]
+
+    def detect_and_encode_batch(self, frames, gsframes):
+        """Батчевая детекция лиц в нескольких кадрах и энкодинги найденных лиц, список для каждого кадра"""
+        batch_locations = self.detect_faces_batch(gsframes)
+        # Один буфер энкодингов на все лица батча
+        buffer = self.encoding_buffer(sum(len(face_locations) for face_locations in batch_locations))
+        
+        results = []
+        offset = 0
+        for frame, face_locations in zip(frames, batch_locations):
+            results.append([
+                (face_location, self.get_face_encoding(frame, face_location, buffer[offset + i]))
+                for i, face_location in enumerate(face_locations)
+            ])
+            offset += len(face_locations)
+        return results
 
     def start_server(self):
         """Запуск IPC сервера для обработки запросов"""
@@ -215,103 +770,129 @@ class HowdyModelDaemon:
         self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.server_socket.bind(self.socket_path)
         self.server_socket.listen(5)
+        self.server_socket.setblocking(False)
+        
+        # Один цикл событий на epoll принимает соединения и читает запросы по мере
+        # поступления данных, готовые запросы обрабатываются фиксированным пулом потоков
+        self.executor = ThreadPoolExecutor(max_workers=self.worker_count)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
         
         print(_("Daemon server started at {}").format(self.socket_path))
         
         while True:
             try:
-                client_socket, _ = self.server_socket.accept()
-                # Обрабатываем каждый запрос в отдельном потоке
-                threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket,),
-                    daemon=True
-                ).start()
+                for key, mask in self.selector.select():
+                    sock = key.fileobj
+                    
+                    if sock is self.server_socket:
+                        try:
+                            client_socket, client_address = self.server_socket.accept()
+                        except BlockingIOError:
+                            continue
+                        # Таймаут ограничивает отправку ответов. Чтение идет только когда
+                        # данные уже есть, по одному вызову recv на событие
+                        client_socket.settimeout(self.send_timeout)
+                        self._send_locks[client_socket] = threading.Lock()
+                        self.selector.register(client_socket, selectors.EVENT_READ, MessageReader())
+                        
+                    else:
+                        self.read_request(sock, key.data)
             except Exception as e:
                 print(_("Error accepting client: {}").format(str(e)))
                 break
 
-    def handle_client(self, client_socket):
+    def read_request(self, client_socket, reader):
+        """Чтение доступной части запроса в цикле событий, полный запрос передается в пул потоков"""
+        try:
+            message = reader.feed(client_socket)
+        except Exception as e:
+            if not isinstance(e, EOFError):
+                print(_("Error handling client request: {}").format(str(e)))
+            self.close_client(client_socket)
+            return
+            
+        # Следующие запросы клиента читаются, пока этот обрабатывается.
+        # Клиент сопоставляет ответы по номеру запроса
+        if message is not None:
+            request_id, request = message
+            self.executor.submit(self.handle_client, client_socket, request_id, request)
+
+    def handle_client(self, client_socket, request_id, request):
         """Обработка клиентского запроса"""
         start_time = time.time()
         
         try:
-            # Получаем размер данных
-            raw_msglen = self.recvall(client_socket, 4)
-            if not raw_msglen:
-                return
-            msglen = struct.unpack('>I', raw_msglen)[0]
-            
-            # Получаем данные запроса
-            raw_data = self.recvall(client_socket, msglen)
-            request = pickle.loads(raw_data)
-            
             # Обрабатываем запрос
             response = self.process_request(request)
+        except Exception as e:
+            print(_("Error handling client request: {}").format(str(e)))
+            # Пустой ответ, чтобы клиент не ждал до таймаута
+            response = None
+            
+        try:
+            message = encode_message(response, request_id)
+        except (TypeError, ValueError) as e:
+            # В сокет еще ничего не записано, остальные запросы соединения не затронуты
+            print(_("Error encoding response: {}").format(str(e)))
+            message = encode_message({'error': str(e)}, request_id)
+            
+        send_lock = self._send_locks.get(client_socket)
+        if send_lock is None:
+            # Клиент уже отключился
+            return
             
+        try:
             # Отправляем ответ
-            response_data = pickle.dumps(response)
-            client_socket.sendall(struct.pack('>I', len(response_data)))
-            client_socket.sendall(response_data)
+            with send_lock:
+                write_message(client_socket, message)
             
             # Обновляем статистику
-            response_time = time.time() - start_time
+            self._response_times.append(time.time() - start_time)
             self.stats['requests_served'] += 1
-            self.stats['average_response_time'] = (
-                (self.stats['average_response_time'] * (self.stats['requests_served'] - 1) + response_time) /
-                self.stats['requests_served']
-            )
             
-        except Exception as e:
+        except OSError as e:
             print(_("Error handling client request: {}").format(str(e)))
-        finally:
-            client_socket.close()
-
-    def recvall(self, sock, n):
-        """Получение точно n байт данных"""
-        data = bytearray()
-        while len(data) < n:
-            packet = sock.recv(n - len(data))
-            if not packet:
-                return None
-            data.extend(packet)
-        return data
+            # Ответ мог уйти частично, соединение больше непригодно.
+            # Цикл событий увидит закрытие и освободит сокет
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close_client(self, client_socket):
+        """Закрытие соединения с клиентом"""
+        self.selector.unregister(client_socket)
+        self._send_locks.pop(client_socket, None)
+        client_socket.close()
 
     def process_request(self, request):
         """Обработка конкретного запроса"""
-        request_type = request.get('type')
-        
-        if request_type == 'get_encodings':
-            username = request.get('username')
-            if not self.check_cache_validity(username):
-                self.load_user_encodings(username)
-            return self.encodings_cache.get(username)
-            
-        elif request_type == 'detect_faces':
-            frame = request.get('frame')
-            return self.detect_faces(frame)
-            
-        elif request_type == 'get_face_encoding':
-            frame = request.get('frame')
-            face_location = request.get('face_location')
-            return self.get_face_encoding(frame, face_location)
-            
-        elif request_type == 'invalidate_cache':
-            username = request.get('username')
-            self.invalidate_user_cache(username)
-            return {'status': 'success'}
-            
-        elif request_type == 'get_stats':
-            return self.stats
-            
-        elif request_type == 'ping':
-            return {'status': 'alive', 'models_loaded': self.models_loaded}
-            
-        else:
-            return {'error': 'Unknown request type'}
+        handler = self._dispatch.get(request.get('type'), self._unknown_request)
+        return handler(request)
+
+    def _get_encodings(self, request):
+        username = request.get('username')
+        if not self.check_cache_validity(username):
+            self.load_user_encodings(username)
+        return self.encodings_cache.get(username)
+
+    def _get_stats(self, request):
+        response_times = list(self._response_times)
+        average = sum(response_times) / len(response_times) if response_times else 0.0
+        return {**self.stats, 'average_response_time': average}
+
+    def _invalidate_cache(self, request):
+        self.invalidate_user_cache(request.get('username'))
+        return {'status': 'success'}
+
+    def _unknown_request(self, request):
+        return {'error': 'Unknown request type'}
 
     def cleanup(self):
         """Очистка ресурсов при завершении"""
+        if self.executor:
+            self.executor.shutdown(wait=False)
         if self.server_socket:
             self.server_socket.close()
         if os.path.exists(self.socket_path):
@@ -330,8 +911,9 @@ class HowdyModelDaemon:
         signal.signal(signal.SIGINT, self.signal_handler)
         
         try:
-            # Предзагружаем модели
-            self.preload_models()
+            # Предзагружаем модели, если они не были загружены до перехода в фон
+            if not self.models_loaded:
+                self.preload_models()
             
             # Запускаем сервер
             self.start_server()
@@ -347,30 +929,78 @@ class HowdyModelDaemon:
 class HowdyDaemonClient:
     """Клиент для взаимодействия с daemon"""
     
-    def __init__(self):
+    def __init__(self, timeout=3.0):
         self.socket_path = "/tmp/howdy_daemon.sock"
+        # Сколько секунд ждать ответа daemon, после этого запрос считается неудачным
+        self.timeout = timeout
+        
+        # Одно постоянное соединение на клиента, открывается при первом запросе.
+        # Запросы из разных потоков идут по нему одновременно, ответы
+        # сопоставляются с запросами по номеру в отдельном потоке чтения
+        self._sock = None
+        self._pending = None
+        self._sock_lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        
+    def _connect(self):
+        """Открытие соединения с daemon и запуск потока чтения ответов"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        
+        self._sock = sock
+        self._pending = {}
+        threading.Thread(target=self._read_responses, args=(sock, self._pending), daemon=True).start()
+        
+    def _read_responses(self, sock, pending):
+        """Передача ответов daemon ожидающим их запросам"""
+        try:
+            while True:
+                request_id, response = recv_message(sock)
+                future = pending.pop(request_id, None)
+                if future:
+                    future.set_result(response)
+        except Exception:
+            pass
+            
+        # Соединение закрыто, следующий запрос откроет новое
+        with self._sock_lock:
+            if self._sock is sock:
+                self._sock = None
+        sock.close()
+        
+        # Ответов на оставшиеся запросы уже не будет
+        for future in list(pending.values()):
+            future.set_result(None)
+        pending.clear()
         
     def send_request(self, request):
         """Отправка запроса daemon"""
         try:
-            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            sock.connect(self.socket_path)
-            
-            # Отправляем запрос
-            request_data = pickle.dumps(request)
-            sock.sendall(struct.pack('>I', len(request_data)))
-            sock.sendall(request_data)
-            
-            # Получаем ответ
-            raw_msglen = self.recvall(sock, 4)
-            if not raw_msglen:
+            future = Future()
+            with self._sock_lock:
+                if self._sock is None:
+                    self._connect()
+                    
+                request_id = next(self._request_ids)
+                pending = self._pending
+                pending[request_id] = future
+                try:
+                    send_message(self._sock, request, request_id)
+                except Exception:
+                    pending.pop(request_id, None)
+                    self._disconnect()
+                    raise
+                    
+            try:
+                response = future.result(timeout=self.timeout)
+            except Exception:
+                # Ответ, пришедший после таймаута, будет отброшен
+                pending.pop(request_id, None)
+                raise
+                
+            # Daemon не смог выполнить запрос, для клиента это такая же неудача
+            if isinstance(response, dict) and 'error' in response:
                 return None
-            msglen = struct.unpack('>I', raw_msglen)[0]
-            
-            raw_data = self.recvall(sock, msglen)
-            response = pickle.loads(raw_data)
-            
-            sock.close()
             return response
             
         except Exception as e:
@@ -378,15 +1008,19 @@ class HowdyDaemonClient:
             # Silent fail for client is better
             return None
     
-    def recvall(self, sock, n):
-        """Получение точно n байт данных"""
-        data = bytearray()
-        while len(data) < n:
-            packet = sock.recv(n - len(data))
-            if not packet:
-                return None
-            data.extend(packet)
-        return data
+    def _disconnect(self):
+        """Разрыв соединения, поток чтения закроет сокет и освободит ожидающие запросы"""
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock = None
+    
+    def close(self):
+        """Закрытие соединения с daemon"""
+        with self._sock_lock:
+            self._disconnect()
     
     def is_daemon_running(self):
         """Проверка работы daemon"""
@@ -401,6 +1035,10 @@ class HowdyDaemonClient:
         """Детекция лиц через daemon"""
         return self.send_request({'type': 'detect_faces', 'frame': frame})
     
+    def detect_faces_batch(self, frames):
+        """Детекция лиц в нескольких кадрах через daemon одним запросом"""
+        return self.send_request({'type': 'detect_faces_batch', 'frames': frames})
+    
     def get_face_encoding(self, frame, face_location):
         """Получение энкодинга лица через daemon"""
         return self.send_request({
@@ -409,6 +1047,30 @@ class HowdyDaemonClient:
             'face_location': face_location
         })
 
+    def get_face_landmarks(self, frame, face_location):
+        """Ключевые точки лица через daemon, (N, 2) int32 массив или None"""
+        return self.send_request({
+            'type': 'get_face_landmarks',
+            'frame': frame,
+            'face_location': face_location
+        })
+
+    def detect_and_encode(self, frame, gsframe):
+        """Детекция лиц и их энкодинги через daemon одним запросом"""
+        return self.send_request({
+            'type': 'detect_and_encode',
+            'frame': frame,
+            'gsframe': gsframe
+        })
+
+    def detect_and_encode_batch(self, frames, gsframes):
+        """Детекция лиц в нескольких кадрах и их энкодинги через daemon одним запросом"""
+        return self.send_request({
+            'type': 'detect_and_encode_batch',
+            'frames': frames,
+            'gsframes': gsframes
+        })
+
 
 def main():
     """Точка входа для daemon"""
@@ -456,6 +1118,10 @@ def main():
             print(_("Error: python-daemon and lockfile modules are required for daemon mode"))
             sys.exit(1)
             
+        # Модели загружаются до перехода в фон: ошибки загрузки видны в терминале,
+        # а память моделей переходит в фоновый процесс при fork без повторного чтения файлов
+        daemon_instance.preload_models()
+        
         # Запуск в фоновом режиме
         with daemon.DaemonContext(
             pidfile=lockfile.FileLock('/tmp/howdy_daemon.pid'),
@@ -8,44 +8,141 @@ import numpy as np
 import threading
 import queue
 import time
-from collections import deque
+import hashlib
+import itertools
+from collections import deque, OrderedDict
+from dataclasses import dataclass
 import multiprocessing as mp
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from i18n import _
+import kernels
 import os
 
 
+@dataclass
+class FaceResult:
+    """Лицо, найденное в кадре"""
+    # Явные слоты вместо dataclass(slots=True), который требует Python 3.10
+    __slots__ = ('face_location', 'face_encoding', 'face_id', 'worker_id')
+    face_location: object
+    face_encoding: np.ndarray
+    face_id: tuple
+    worker_id: int
+
+
+@dataclass
+class FrameResult:
+    """Результат обработки кадра рабочим потоком"""
+    __slots__ = ('frame_id', 'timestamp', 'faces', 'processing_time', 'worker_id')
+    frame_id: int
+    timestamp: float
+    faces: list
+    processing_time: float
+    worker_id: int
+
+
+class WorkerStats:
+    """Счетчики одного рабочего потока ParallelVideoProcessor"""
+    # Слоты со значениями по умолчанию несовместимы с dataclass без slots=True (Python 3.10)
+    __slots__ = ('total_frames', 'successful_detections', 'failed_detections', 'faces')
+    
+    def __init__(self):
+        self.total_frames = 0
+        self.successful_detections = 0
+        self.failed_detections = 0
+        self.faces = 0
+    
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class AdaptiveStats:
+    """Статистика AdaptiveFrameProcessor"""
+    __slots__ = ('frames_processed', 'frames_skipped', 'average_processing_time', 'current_fps',
+                 'resolution_adaptations')
+    
+    def __init__(self):
+        self.frames_processed = 0
+        self.frames_skipped = 0
+        self.average_processing_time = 0
+        self.current_fps = 0
+        self.resolution_adaptations = 0
+    
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
 class FrameBuffer:
     """Кольцевой буфер для эффективного хранения кадров"""
     
     def __init__(self, max_size=10):
-        self.buffer = deque(maxlen=max_size)
-        self.lock = threading.RLock()
-        self.frame_metadata = deque(maxlen=max_size)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Слоты выделяются при первом кадре, когда известна его форма,
+        # и дальше переиспользуются: кадр копируется в готовый массив
+        self._slots = [None] * max_size
+        # Слоты с кадрами, переданными вызывающим кодом во владение буферу:
+        # в них нельзя копировать, кадр мог остаться у вызывающего кода
+        self._adopted = [False] * max_size
+        self.frame_metadata = [None] * max_size
+        self._head = 0
+        self._count = 0
     
-    def add_frame(self, frame, metadata=None):
-        """Добавление кадра в буфер"""
+    def add_frame(self, frame, metadata=None, owned=False):
+        """
+        Добавление кадра в буфер.
+        owned=True передает буферу свежий массив (например, результат cv2.resize),
+        который вызывающий код больше не изменяет, тогда кадр сохраняется без копирования
+        """
         with self.lock:
-            self.buffer.append(frame.copy())
-            self.frame_metadata.append(metadata or {})
+            index = self._head
+            if owned:
+                self._slots[index] = frame
+                self._adopted[index] = True
+            else:
+                slot = self._slots[index]
+                # Новый массив нужен только если изменилось разрешение кадра
+                if (slot is None or self._adopted[index]
+                        or slot.shape != frame.shape or slot.dtype != frame.dtype):
+                    slot = self._slots[index] = np.empty_like(frame)
+                    self._adopted[index] = False
+                np.copyto(slot, frame)
+            
+            self.frame_metadata[index] = metadata or {}
+            self._head = (index + 1) % self.max_size
+            self._count = min(self._count + 1, self.max_size)
+    
+    def _latest(self, count):
+        """Кадры (только для чтения) и метаданные последних count записей, от старых к новым"""
+        count = min(count, self._count)
+        frames = []
+        metadata = []
+        for offset in range(count, 0, -1):
+            index = (self._head - offset) % self.max_size
+            # Представление действительно, пока слот не перезаписан следующими кадрами
+            view = self._slots[index].view()
+            view.flags.writeable = False
+            frames.append(view)
+            metadata.append(self.frame_metadata[index])
+        return frames, metadata
     
     def get_latest_frames(self, count=1):
         """Получение последних кадров"""
         with self.lock:
-            if len(self.buffer) < count:
-                return list(self.buffer), list(self.frame_metadata)
-            return list(self.buffer)[-count:], list(self.frame_metadata)[-count:]
+            return self._latest(count)
     
     def get_frame_history(self):
         """Получение всей истории кадров"""
         with self.lock:
-            return list(self.buffer), list(self.frame_metadata)
+            return self._latest(self._count)
     
     def clear(self):
         """Очистка буфера"""
         with self.lock:
-            self.buffer.clear()
-            self.frame_metadata.clear()
+            # Слоты остаются выделенными для следующих кадров
+            self.frame_metadata = [None] * self.max_size
+            self._head = 0
+            self._count = 0
 
 
 class AdaptiveFrameProcessor:
@@ -62,16 +159,21 @@ class AdaptiveFrameProcessor:
         # Динамические параметры
         self.current_skip_rate = 1  # Пропуск каждого N-го кадра
         self.current_resolution_scale = 1.0  # Масштаб разрешения
-        self.processing_times = deque(maxlen=30)  # История времени обработки
+        # Время обработки последних кадров в кольце с текущей суммой,
+        # среднее обновляется за O(1) без списков и numpy
+        self.processing_window = 10
+        self._processing_times = [0.0] * self.processing_window
+        self._processing_index = 0
+        self._processing_sum = 0.0
+        self._processing_count = 0
         
         # Статистика
-        self.stats = {
-            'frames_processed': 0,
-            'frames_skipped': 0,
-            'average_processing_time': 0,
-            'current_fps': 0,
-            'resolution_adaptations': 0
-        }
+        self.stats = AdaptiveStats()
+        
+        # Размер кадра после масштабирования, пересчитывается только при смене
+        # размера входного кадра или масштаба
+        self._size_key = None
+        self._scaled_size = None
         
         # Пороги для адаптации
         self.slow_processing_threshold = 0.1  # 100ms
@@ -79,12 +181,16 @@ class AdaptiveFrameProcessor:
         
     def adapt_parameters(self, processing_time):
         """Адаптация параметров на основе времени обработки"""
-        self.processing_times.append(processing_time)
+        index = self._processing_index
+        self._processing_sum += processing_time - self._processing_times[index]
+        self._processing_times[index] = processing_time
+        self._processing_index = (index + 1) % self.processing_window
+        self._processing_count += 1
         
-        if len(self.processing_times) < 5:
+        if self._processing_count < 5:
             return
         
-        avg_time = np.mean(list(self.processing_times)[-10:])
+        avg_time = self._processing_sum / min(self._processing_count, self.processing_window)
         
         # Если обработка медленная, увеличиваем пропуск кадров
         if avg_time > self.slow_processing_threshold:
@@ -93,7 +199,7 @@ class AdaptiveFrameProcessor:
                 print(_("Adapting: increasing frame skip to {}").format(self.current_skip_rate))
             elif self.current_resolution_scale > 0.5:
                 self.current_resolution_scale *= 0.8
-                self.stats['resolution_adaptations'] += 1
+                self.stats.resolution_adaptations += 1
                 print(_("Adapting: reducing resolution scale to {:.2f}").format(self.current_resolution_scale))
         
         # Если обработка быстрая, можем уменьшить пропуск
@@ -106,29 +212,47 @@ class AdaptiveFrameProcessor:
                 print(_("Adapting: increasing resolution scale to {:.2f}").format(self.current_resolution_scale))
         
         # Обновляем статистику
-        self.stats['average_processing_time'] = avg_time
+        self.stats.average_processing_time = avg_time
         if avg_time > 0:
-            self.stats['current_fps'] = 1.0 / avg_time
+            self.stats.current_fps = 1.0 / avg_time
     
     def should_process_frame(self, frame_number):
         """Определение, нужно ли обрабатывать кадр"""
         if frame_number % self.current_skip_rate == 0:
             return True
         else:
-            self.stats['frames_skipped'] += 1
+            self.stats.frames_skipped += 1
             return False
     
-    def prepare_frame(self, frame):
-        """Подготовка кадра с учетом текущих параметров"""
-        if self.current_resolution_scale != 1.0:
+    def _target_size(self, frame):
+        """Размер (ширина, высота) кадра с учетом текущего масштаба, None если масштабировать не нужно"""
+        key = (frame.shape[:2], self.current_resolution_scale)
+        if key != self._size_key:
             height, width = frame.shape[:2]
             new_height = int(height * self.current_resolution_scale)
             new_width = int(width * self.current_resolution_scale)
             
-            if new_height > 0 and new_width > 0:
-                frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
+            self._size_key = key
+            self._scaled_size = (new_width, new_height) if new_height > 0 and new_width > 0 else None
+        return self._scaled_size
+    
+    def prepare_color(self, frame):
+        """Подготовка цветного кадра с учетом текущих параметров"""
+        if self.current_resolution_scale != 1.0:
+            size = self._target_size(frame)
+            if size is not None:
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
         
         return frame
+    
+    def prepare_gray(self, gsframe):
+        """Подготовка серого кадра для детекции лиц, ближайший сосед заметно быстрее INTER_AREA"""
+        if self.current_resolution_scale != 1.0:
+            size = self._target_size(gsframe)
+            if size is not None:
+                gsframe = cv2.resize(gsframe, size, interpolation=cv2.INTER_NEAREST)
+        
+        return gsframe
 
 
 class ParallelVideoProcessor:
@@ -141,24 +265,34 @@ class ParallelVideoProcessor:
         # Количество рабочих потоков
         self.num_workers = min(4, mp.cpu_count())
         
+        # Кадры отправляются в daemon батчами: до batch_size кадров,
+        # собранных не дольше batch_timeout секунд
+        self.batch_size = 4
+        self.batch_timeout = 0.02
+        
         # Очереди для работы
-        self.input_queue = queue.Queue(maxsize=10)
-        self.result_queue = queue.Queue()
+        # У каждого потока своя очередь, чтобы потоки не боролись за одну блокировку.
+        # Кадры раскладываются по очередям сериями по batch_size, так батчи остаются полными
+        self.max_queued_frames = 10
+        self.worker_queues = [queue.SimpleQueue() for i in range(self.num_workers)]
+        self._next_queue = 0
+        self._queued_in_series = 0
+        self.result_queue = queue.SimpleQueue()
+        
+        # Идентификаторы кадров - возрастающие целые числа, лица - пары (кадр, номер лица)
+        self._frame_ids = itertools.count()
         
         # Пул потоков
         self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
         self.futures = []
         
-        # Статистика
-        self.processing_stats = {
-            'total_frames': 0,
-            'successful_detections': 0,
-            'failed_detections': 0,
-            'average_faces_per_frame': 0
-        }
+        # Статистика: каждый поток пишет только в свои счетчики,
+        # общая статистика собирается при запросе в get_stats
+        self._worker_stats = [WorkerStats() for i in range(self.num_workers)]
         
         # Флаг остановки
         self.stop_processing = threading.Event()
+        self._feed_thread = None
     
     def start_processing(self):
         """Запуск параллельной обработки"""
@@ -166,85 +300,137 @@ class ParallelVideoProcessor:
             future = self.executor.submit(self._worker_thread, i)
             self.futures.append(future)
     
+    def start_feeding(self, video_capture):
+        """
+        Запуск потока подготовки: анализ качества и адаптивная подготовка кадров из video_capture
+        идут в нем, отдельно и от захвата, и от детекции в рабочих потоках
+        """
+        self._feed_thread = threading.Thread(target=self._feed_worker, args=(video_capture,), daemon=True)
+        self._feed_thread.start()
+    
+    def _feed_worker(self, video_capture):
+        """Поток подготовки кадров для рабочих потоков"""
+        while not self.stop_processing.is_set():
+            frame, gsframe = video_capture.read_optimized_frame()
+            if frame is not None:
+                # Если очереди полны, кадр отбрасывается, следующий будет свежее
+                self.add_frame(frame, gsframe)
+    
     def _worker_thread(self, worker_id):
         """Рабочий поток для обработки кадров"""
-        while not self.stop_processing.is_set():
+        stopping = False
+        while not stopping and not self.stop_processing.is_set():
             try:
-                frame_data = self.input_queue.get(timeout=1.0)
-                if frame_data is None:
-                    break
+                batch, stopping = self._next_batch(self.worker_queues[worker_id])
+                if not batch:
+                    continue
                 
-                result = self._process_frame_data(frame_data, worker_id)
-                if result:
+                for result in self._process_batch(batch, worker_id):
                     self.result_queue.put(result)
                 
-                self.input_queue.task_done()
-                
             except queue.Empty:
                 continue
             except Exception as e:
                 print(_("Error in worker thread {}: {}").format(worker_id, str(e)))
     
-    def _process_frame_data(self, frame_data, worker_id):
-        """Обработка данных кадра в рабочем потоке"""
-        frame, gsframe, timestamp, frame_id = frame_data
+    def _next_batch(self, input_queue):
+        """
+        Сбор батча кадров: ждем первый кадр, затем добираем до batch_size кадров в течение batch_timeout.
+        Возвращает (кадры, получен ли сигнал остановки)
+        """
+        frame_data = input_queue.get(timeout=1.0)
+        if frame_data is None:
+            return [], True
+        
+        batch = [frame_data]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            
+            try:
+                frame_data = input_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            
+            if frame_data is None:
+                return batch, True
+            batch.append(frame_data)
         
+        return batch, False
+    
+    def _process_batch(self, batch, worker_id):
+        """Обработка батча кадров в рабочем потоке одним запросом к daemon"""
         start_time = time.time()
         
         try:
-            # Детекция лиц
-            face_locations = self.daemon_client.detect_faces(gsframe)
-            
-            results = []
-            for i, face_location in enumerate(face_locations):
-                # Получение энкодинга лица
-                face_encoding = self.daemon_client.get_face_encoding(frame, face_location)
-                
-                if face_encoding is not None:
-                    results.append({
-                        'face_location': face_location,
-                        'face_encoding': face_encoding,
-                        'face_id': f"{frame_id}_{i}",
-                        'worker_id': worker_id
-                    })
-            
+            # Детекция лиц и их энкодинги для всех кадров батча
+            batch_faces = self.daemon_client.detect_and_encode_batch(
+                [frame_data[0] for frame_data in batch],
+                [frame_data[1] for frame_data in batch]
+            )
             processing_time = time.time() - start_time
             
-            # Обновляем статистику
-            self.processing_stats['total_frames'] += 1
-            if results:
-                self.processing_stats['successful_detections'] += 1
-                self.processing_stats['average_faces_per_frame'] = (
-                    (self.processing_stats['average_faces_per_frame'] * (self.processing_stats['total_frames'] - 1) + len(results)) /
-                    self.processing_stats['total_frames']
-                )
-            else:
-                self.processing_stats['failed_detections'] += 1
-            
-            return {
-                'frame_id': frame_id,
-                'timestamp': timestamp,
-                'faces': results,
-                'processing_time': processing_time,
-                'worker_id': worker_id
-            }
+            return [
+                self._frame_result(frame_data, faces, processing_time, worker_id)
+                for frame_data, faces in zip(batch, batch_faces)
+            ]
             
         except Exception as e:
             print(_("Error processing frame in worker {}: {}").format(worker_id, str(e)))
-            return None
+            return []
+    
+    def _frame_result(self, frame_data, faces, processing_time, worker_id):
+        """Результат обработки одного кадра батча"""
+        frame, gsframe, timestamp, frame_id = frame_data
+        
+        results = []
+        for i, (face_location, face_encoding) in enumerate(faces):
+            if face_encoding is not None:
+                results.append(FaceResult(face_location, face_encoding, (frame_id, i), worker_id))
+        
+        # Обновляем статистику потока
+        stats = self._worker_stats[worker_id]
+        stats.total_frames += 1
+        if results:
+            stats.successful_detections += 1
+            stats.faces += len(results)
+        else:
+            stats.failed_detections += 1
+        
+        return FrameResult(frame_id, timestamp, results, processing_time, worker_id)
     
     def add_frame(self, frame, gsframe, timestamp=None, frame_id=None):
         """Добавление кадра для обработки"""
         if timestamp is None:
             timestamp = time.time()
         if frame_id is None:
-            frame_id = f"frame_{int(timestamp * 1000)}"
+            frame_id = next(self._frame_ids)
         
-        try:
-            self.input_queue.put((frame, gsframe, timestamp, frame_id), block=False)
-            return True
-        except queue.Full:
+        # SimpleQueue не ограничивает размер, лимит кадров в очереди проверяется здесь
+        if sum(input_queue.qsize() for input_queue in self.worker_queues) >= self.max_queued_frames:
             return False
+        
+        self.worker_queues[self._next_queue].put((frame, gsframe, timestamp, frame_id))
+        
+        self._queued_in_series += 1
+        if self._queued_in_series >= self.batch_size:
+            self._queued_in_series = 0
+            self._next_queue = (self._next_queue + 1) % self.num_workers
+        return True
+    
+    def get_stats(self):
+        """Статистика обработки, суммированная по рабочим потокам"""
+        total_frames = sum(stats.total_frames for stats in self._worker_stats)
+        faces = sum(stats.faces for stats in self._worker_stats)
+        
+        return {
+            'total_frames': total_frames,
+            'successful_detections': sum(stats.successful_detections for stats in self._worker_stats),
+            'failed_detections': sum(stats.failed_detections for stats in self._worker_stats),
+            'average_faces_per_frame': faces / total_frames if total_frames else 0
+        }
     
     def get_result(self, timeout=0.1):
         """Получение результата обработки"""
@@ -257,12 +443,12 @@ class ParallelVideoProcessor:
         """Остановка обработки"""
         self.stop_processing.set()
         
+        if self._feed_thread is not None:
+            self._feed_thread.join(timeout=2.0)
+        
         # Добавляем сигналы остановки для всех потоков
-        for _ in range(self.num_workers):
-            try:
-                self.input_queue.put(None, block=False)
-            except queue.Full:
-                pass
+        for input_queue in self.worker_queues:
+            input_queue.put(None)
         
         # Ждем завершения всех потоков
         for future in self.futures:
@@ -280,13 +466,34 @@ class SmartFrameAnalyzer:
     def __init__(self, config):
         self.config = config
         
-        # Кэш для результатов анализа
-        self.analysis_cache = {}
+        # LRU кэш для результатов анализа
+        self.analysis_cache = OrderedDict()
         self.cache_max_size = 100
         
         # История анализа для предсказаний
         self.frame_history = deque(maxlen=20)
-        self.quality_history = deque(maxlen=10)
+        self.quality_history = kernels.RingBuffer(10)
+        
+        # Веса наклона прямой по методу наименьших квадратов для 3-5 точек:
+        # тренд - скалярное произведение весов на последние оценки
+        self._trend_weights = {}
+        for n in range(3, 6):
+            x = np.arange(n, dtype=np.float32) - (n - 1) / 2
+            self._trend_weights[n] = x / np.dot(x, x)
+        
+        # Проверка изменения кадра по 64 редким пикселям: если кадр почти не изменился
+        # с последнего анализа, возвращается прошлый результат без хэша и анализа
+        self.sample_count = 64
+        self.unchanged_threshold = 2.0  # Средняя разница на пиксель выборки
+        self._sample_indices = None
+        self._last_sample = None
+        self._last_result = None
+        
+        # Буфер интегрального изображения, переиспользуется пока не изменится размер кадра
+        self._integral_buffer = None
+        
+        # Анализ на OpenCL устройстве через cv2.UMat, если оно есть
+        self.use_opencl = config.getboolean("video", "use_opencl", fallback=False) and cv2.ocl.haveOpenCL()
         
         # Параметры анализа качества
         self.blur_threshold = 100
@@ -295,42 +502,49 @@ class SmartFrameAnalyzer:
         
     def analyze_frame_quality(self, frame):
         """Анализ качества кадра"""
+        sample = self._sample_frame(frame)
+        if self._last_result is not None and sample.shape == self._last_sample.shape:
+            if np.abs(sample - self._last_sample).sum() < self.unchanged_threshold * len(sample):
+                return self._last_result
+        
         # Генерируем хэш кадра для кэширования
         frame_hash = self._generate_frame_hash(frame)
         
-        if frame_hash in self.analysis_cache:
-            return self.analysis_cache[frame_hash]
+        result = self.analysis_cache.get(frame_hash)
+        if result is not None:
+            self.analysis_cache.move_to_end(frame_hash)
+            self._last_sample, self._last_result = sample, result
+            return result
         
-        # Преобразуем в градации серого если нужно
-        if len(frame.shape) == 3:
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.use_opencl:
+            blur_score, brightness, contrast, region_means = self._opencl_statistics(frame)
         else:
-            gray = frame
+            # Преобразуем в градации серого если нужно
+            if len(frame.shape) == 3:
+                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            else:
+                gray = frame
+            
+            # Резкость, яркость, контрастность и яркость четвертей кадра за один проход
+            h, w = gray.shape
+            if self._integral_buffer is None or self._integral_buffer.shape != (h + 1, w + 1):
+                self._integral_buffer = np.empty((h + 1, w + 1), dtype=np.int32)
+            
+            blur_score, brightness, contrast, region_means = kernels.gray_statistics(gray, self._integral_buffer)
         
         # Анализ резкости (размытия)
-        blur_score = cv2.Laplacian(gray, cv2.CV_64F).var()
         is_sharp = blur_score > self.blur_threshold
         
         # Анализ яркости
-        brightness = np.mean(gray)
         is_bright_enough = self.brightness_range[0] <= brightness <= self.brightness_range[1]
         
         # Анализ контрастности
-        contrast = gray.std()
         has_good_contrast = contrast > self.contrast_threshold
         
-        # Анализ равномерности освещения
-        # Разделяем кадр на регионы и анализируем различия в освещении
-        h, w = gray.shape
-        regions = [
-            gray[:h//2, :w//2],    # Верх-лево
-            gray[:h//2, w//2:],    # Верх-право
-            gray[h//2:, :w//2],    # Низ-лево
-            gray[h//2:, w//2:]     # Низ-право
-        ]
-        
-        region_means = [np.mean(region) for region in regions]
-        lighting_variance = np.var(region_means)
+        # Анализ равномерности освещения по различиям между регионами кадра,
+        # дисперсия четырех чисел считается без numpy
+        mean_brightness = sum(region_means) / 4
+        lighting_variance = sum((region_mean - mean_brightness) ** 2 for region_mean in region_means) / 4
         has_even_lighting = lighting_variance < 500  # Настраиваемый порог
         
         # Общая оценка качества
@@ -356,29 +570,54 @@ class SmartFrameAnalyzer:
         
         # Кэшируем результат
         self._cache_result(frame_hash, result)
+        self._last_sample, self._last_result = sample, result
         
         # Добавляем в историю
         self.quality_history.append(quality_score)
         
         return result
     
-    def _generate_frame_hash(self, frame):
-        """Генерация хэша кадра для кэширования"""
-        # Простой хэш на основе среднего значения пикселей и размера
+    def _opencl_statistics(self, frame):
+        """Те же метрики, что и kernels.gray_statistics, с вычислением на OpenCL устройстве"""
+        # Кадр загружается на устройство один раз, все дальнейшие операции идут там
+        ugray = cv2.UMat(frame)
         if len(frame.shape) == 3:
-            mean_val = np.mean(frame)
-        else:
-            mean_val = np.mean(frame)
+            ugray = cv2.cvtColor(ugray, cv2.COLOR_BGR2GRAY)
+        
+        # Лапласиан 8-битного кадра помещается в 16-битные целые без потерь
+        _, blur_stddev = cv2.meanStdDev(cv2.Laplacian(ugray, cv2.CV_16S))
+        mean, stddev = cv2.meanStdDev(ugray)
         
         h, w = frame.shape[:2]
-        return f"{h}x{w}_{mean_val:.2f}_{np.std(frame):.2f}"
+        region_means = tuple(
+            cv2.mean(cv2.UMat(ugray, rows, cols))[0]
+            for rows in ((0, h // 2), (h // 2, h))
+            for cols in ((0, w // 2), (w // 2, w))
+        )
+        
+        return float(blur_stddev.get()[0, 0]) ** 2, float(mean.get()[0, 0]), float(stddev.get()[0, 0]), region_means
+    
+    def _sample_frame(self, frame):
+        """Выборка sample_count пикселей кадра в фиксированных позициях, int16 для вычитания"""
+        if self._sample_indices is None or self._sample_indices[0] != frame.size:
+            # Позиции выбираются один раз для каждого размера кадра
+            indices = np.random.default_rng(0).integers(0, frame.size, size=self.sample_count)
+            self._sample_indices = (frame.size, indices)
+        return frame.reshape(-1)[self._sample_indices[1]].astype(np.int16)
+    
+    def _generate_frame_hash(self, frame):
+        """Генерация хэша кадра для кэширования"""
+        # Хэшируется миниатюра 16x16 вместо полных проходов по кадру,
+        # ключ - целое число, а не строка
+        thumbnail = cv2.resize(frame, (16, 16), interpolation=cv2.INTER_AREA)
+        digest = hashlib.blake2b(thumbnail.tobytes(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
     
     def _cache_result(self, frame_hash, result):
         """Кэширование результата анализа"""
         if len(self.analysis_cache) >= self.cache_max_size:
-            # Удаляем старые записи
-            oldest_key = next(iter(self.analysis_cache))
-            del self.analysis_cache[oldest_key]
+            # Удаляем давно не использованную запись
+            self.analysis_cache.popitem(last=False)
         
         self.analysis_cache[frame_hash] = result
     
@@ -387,12 +626,12 @@ class SmartFrameAnalyzer:
         if len(self.quality_history) < 3:
             return 0.5  # Нейтральное предсказание
         
-        recent_scores = list(self.quality_history)[-5:]
+        recent_scores = self.quality_history.last(5)
         
         # Простое предсказание на основе тренда
         if len(recent_scores) >= 3:
-            trend = np.polyfit(range(len(recent_scores)), recent_scores, 1)[0]
-            last_score = recent_scores[-1]
+            trend = float(np.dot(self._trend_weights[len(recent_scores)], recent_scores))
+            last_score = float(recent_scores[-1])
             predicted_score = last_score + trend
             
             return max(0, min(1, predicted_score))
@@ -434,25 +673,92 @@ class OptimizedVideoCapture:
         self.enable_adaptive_processing = config.getboolean("video", "enable_adaptive_processing", fallback=True)
         
         self.frame_counter = 0
-    
-    def read_optimized_frame(self):
-        """Оптимизированное чтение кадра"""
-        start_time = time.time()
-        
-        # Захватываем кадр
-        try:
-            frame, gsframe = self.base_capture.read_frame()
-        except Exception as e:
-            print(_("Error capturing frame: {}").format(str(e)))
-            return None, None
         
+        # Необязательный поток захвата, камера читается в нем, а не в вызывающем потоке
+        self._capture_thread = None
+        self._captured_frames = queue.Queue(maxsize=3)
+        self._stop_capture = threading.Event()
+    
+    def start_capture_thread(self):
+        """Запуск отдельного потока захвата кадров с камеры"""
+        if self._capture_thread is None:
+            self._stop_capture.clear()
+            self._capture_thread = threading.Thread(target=self._capture_worker, daemon=True)
+            self._capture_thread.start()
+    
+    def stop_capture_thread(self):
+        """Остановка потока захвата"""
+        if self._capture_thread is not None:
+            self._stop_capture.set()
+            self._capture_thread.join(timeout=2.0)
+            self._capture_thread = None
+    
+    def _capture_worker(self):
+        """Поток захвата: кадры с камеры в короткую очередь, при переполнении вытесняются самые старые"""
+        while not self._stop_capture.is_set():
+            try:
+                captured = self._capture_frame()
+            except Exception as e:
+                print(_("Error capturing frame: {}").format(str(e)))
+                # Не крутимся вхолостую, если камера недоступна
+                self._stop_capture.wait(0.1)
+                continue
+            
+            if captured[0] is None:
+                continue
+            
+            while True:
+                try:
+                    self._captured_frames.put_nowait(captured)
+                    break
+                except queue.Full:
+                    try:
+                        self._captured_frames.get_nowait()
+                    except queue.Empty:
+                        pass
+    
+    def _capture_frame(self):
+        """
+        Захват следующего кадра с камеры, ошибки камеры пробрасываются.
+        Возвращает (кадр, серый кадр, номер кадра), кадры None если кадр пропущен адаптивной обработкой
+        """
         self.frame_counter += 1
-        self.capture_stats['total_frames_captured'] += 1
+        frame_number = self.frame_counter
         
-        # Проверяем, нужно ли обрабатывать кадр (адаптивная обработка)
+        # Проверяем, нужно ли обрабатывать кадр (адаптивная обработка) еще до чтения:
+        # пропускаемый кадр только забираем из камеры, без декодирования и перевода в серый
         if self.enable_adaptive_processing:
-            if not self.adaptive_processor.should_process_frame(self.frame_counter):
+            if not self.adaptive_processor.should_process_frame(frame_number):
+                self.base_capture.internal.grab()
+                
+                self.capture_stats['total_frames_captured'] += 1
                 self.capture_stats['frames_skipped_adaptive'] += 1
+                return None, None, frame_number
+        
+        # Захватываем кадр
+        frame, gsframe = self.base_capture.read_frame()
+        
+        self.capture_stats['total_frames_captured'] += 1
+        return frame, gsframe, frame_number
+    
+    def read_optimized_frame(self):
+        """Оптимизированное чтение кадра"""
+        if self._capture_thread is not None:
+            # Кадры захватывает свой поток, здесь остаются только анализ и подготовка
+            try:
+                frame, gsframe, frame_number = self._captured_frames.get(timeout=1.0)
+            except queue.Empty:
+                return None, None
+            start_time = time.time()
+        else:
+            start_time = time.time()
+            try:
+                frame, gsframe, frame_number = self._capture_frame()
+            except Exception as e:
+                print(_("Error capturing frame: {}").format(str(e)))
+                return None, None
+            
+            if frame is None:
                 return None, None
         
         # Анализируем качество кадра
@@ -464,18 +770,20 @@ class OptimizedVideoCapture:
                 return None, None
         
         # Подготавливаем кадр с учетом адаптивных параметров
+        captured_frame = frame
         if self.enable_adaptive_processing:
-            frame = self.adaptive_processor.prepare_frame(frame)
-            gsframe = self.adaptive_processor.prepare_frame(gsframe)
+            frame = self.adaptive_processor.prepare_color(frame)
+            gsframe = self.adaptive_processor.prepare_gray(gsframe)
         
         # Добавляем кадр в буфер
         frame_metadata = {
             'timestamp': time.time(),
-            'frame_number': self.frame_counter,
+            'frame_number': frame_number,
             'quality_analysis': quality_analysis if self.enable_quality_filtering else None
         }
         
-        self.frame_buffer.add_frame(frame, frame_metadata)
+        # Уменьшенный кадр - новый массив, его буфер может забрать без копирования
+        self.frame_buffer.add_frame(frame, frame_metadata, owned=frame is not captured_frame)
         
         # Обновляем статистику
         capture_time = time.time() - start_time
@@ -508,19 +816,24 @@ class OptimizedVideoCapture:
             'average_quality': np.mean(quality_scores) if quality_scores else 0,
             'quality_variance': np.var(quality_scores) if quality_scores else 0,
             'capture_stats': self.capture_stats.copy(),
-            'adaptive_stats': self.adaptive_processor.stats.copy()
+            'adaptive_stats': self.adaptive_processor.stats.as_dict()
         }
     
     def release(self):
         """Освобождение ресурсов"""
+        self.stop_capture_thread()
+        
         if hasattr(self, 'base_capture'):
             self.base_capture.release()
         
         self.frame_buffer.clear()
 
 
-def create_optimized_video_system(config, daemon_client):
-    """Фабричная функция для создания оптимизированной видео системы"""
+def create_optimized_video_system(config, daemon_client, pipeline=False):
+    """
+    Фабричная функция для создания оптимизированной видео системы.
+    pipeline=True запускает конвейер: поток захвата, поток подготовки кадров и рабочие потоки детекции
+    """
     
     # Создаем оптимизированный захват видео
     video_capture = OptimizedVideoCapture(config)
@@ -529,6 +842,10 @@ def create_optimized_video_system(config, daemon_client):
     parallel_processor = ParallelVideoProcessor(config, daemon_client)
     parallel_processor.start_processing()
     
+    if pipeline:
+        video_capture.start_capture_thread()
+        parallel_processor.start_feeding(video_capture)
+    
     return {
         'video_capture': video_capture,
         'parallel_processor': parallel_processor,